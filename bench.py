@@ -0,0 +1,428 @@
+"""bot.py のオフライン・ベンチマーク（Discord に接続しない）。
+
+TextChannel / Message / Interaction の代わりにメモリ上の偽物を使い、
+投稿・承認/却下・自動削除・定期掃除の負荷を流して ops/sec・p50/p99・KV書き込み量を出す。
+
+    python bench.py --seed-posts 100000 --ops 2000
+    python bench.py --backend sqlite --latency-ms 5
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import datetime
+import importlib
+import itertools
+import json
+import struct
+import tempfile
+
+import discord
+from aiohttp import web
+
+bot = None  # main() で作業ディレクトリを移してから import する
+
+# ========= 偽 Discord =========
+_ids = itertools.count(discord.utils.time_snowflake(discord.utils.utcnow()))
+REST_LATENCY = 0.0
+GUILD = discord.Object(id=1)
+
+async def _rest_delay():
+    if REST_LATENCY:
+        await asyncio.sleep(REST_LATENCY)
+
+class FakeMessage:
+    def __init__(self, channel: "FakeTextChannel", msg_id: int | None = None, content: str = "", embed=None, view=None):
+        self.id = msg_id if msg_id is not None else next(_ids)
+        self.channel = channel
+        self.guild = GUILD
+        self.content = content
+        self.embeds = [embed] if embed is not None else []
+        self.view = view
+        self.pinned = False
+        self.author = FakeUser(42)
+        self.created_at = discord.utils.snowflake_time(self.id)
+        self.jump_url = f"https://discord.com/channels/1/{channel.id}/{self.id}"
+
+    async def delete(self):
+        await _rest_delay()
+        self.channel.messages.pop(self.id, None)
+
+    async def edit(self, *, embed=None, view=None, **kwargs):
+        await _rest_delay()
+        if embed is not None:
+            self.embeds = [embed]
+        if view is not None:
+            self.view = view
+        return self
+
+class FakeWebhook:
+    """掲示板の投稿用 Webhook。送信・編集は FakeTextChannel のメッセージを直接書き換える。"""
+    def __init__(self, channel: "FakeTextChannel", user: "FakeUser"):
+        self.id = next(_ids)
+        self.token = f"token-{self.id}"
+        self.channel = channel
+        self.user = user
+
+    async def send(self, content: str = "", *, embed=None, username=None, wait=False, **kwargs):
+        await _rest_delay()
+        m = FakeMessage(self.channel, content=content, embed=embed)
+        m.author = FakeUser(self.id)
+        m.author.display_name = username
+        self.channel.messages[m.id] = m
+        return m
+
+    async def edit_message(self, message_id: int, *, embed=None, **kwargs):
+        await _rest_delay()
+        m = self.channel.messages[message_id]
+        if embed is not None:
+            m.embeds = [embed]
+        return m
+
+class FakeTextChannel(discord.TextChannel):
+    """isinstance(ch, discord.TextChannel) を通すための最小限の偽チャンネル。"""
+    def __init__(self, channel_id: int):
+        self.id = channel_id
+        self.guild = GUILD
+        self.messages: dict[int, FakeMessage] = {}
+        self.hooks: list[FakeWebhook] = []
+
+    @property
+    def mention(self) -> str:
+        return f"<#{self.id}>"
+
+    async def send(self, content: str = "", *, embed=None, embeds=None, view=None, **kwargs):
+        await _rest_delay()
+        m = FakeMessage(self, content=content, embed=embed, view=view)
+        if embeds:
+            m.embeds = list(embeds)
+        self.messages[m.id] = m
+        return m
+
+    async def create_webhook(self, *, name: str, reason=None):
+        await _rest_delay()
+        wh = FakeWebhook(self, BOT_USER)
+        self.hooks.append(wh)
+        return wh
+
+    async def webhooks(self):
+        await _rest_delay()
+        return list(self.hooks)
+
+    async def fetch_message(self, msg_id: int):
+        await _rest_delay()
+        try:
+            return self.messages[msg_id]
+        except KeyError:
+            raise discord.NotFound(_FakeResponse(404), "Unknown Message")
+
+    def get_partial_message(self, msg_id: int):
+        return self.messages.get(msg_id) or FakeMessage(self, msg_id=msg_id)
+
+    async def delete_messages(self, messages, **kwargs):
+        await _rest_delay()
+        for m in messages:
+            self.messages.pop(m.id, None)
+
+    async def history(self, *, limit=100, before=None, after=None, oldest_first=None):
+        lo = after.id if after is not None else 0
+        hi = discord.utils.time_snowflake(before) if isinstance(before, datetime.datetime) else (before.id if before else 1 << 64)
+        ids = sorted((i for i in self.messages if lo < i < hi), reverse=not oldest_first)
+        for n, i in enumerate(ids):
+            if limit is not None and n >= limit:
+                return
+            if n % 100 == 0:
+                await _rest_delay()  # 1ページ=100件ごとに1リクエスト
+            m = self.messages.get(i)
+            if m is not None:
+                yield m
+
+class _FakeResponse:
+    def __init__(self, status: int):
+        self.status = status
+        self.reason = "fake"
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.display_name = f"user{user_id}"
+        self.mention = f"<@{user_id}>"
+        self.bot = False
+
+    def __str__(self):
+        return f"user{self.id}#0"
+
+class FakeResponse:
+    async def defer(self, **kwargs):
+        pass
+
+    async def send_message(self, *args, **kwargs):
+        pass
+
+    async def send_modal(self, modal):
+        pass
+
+class FakeFollowup:
+    async def send(self, *args, **kwargs):
+        await _rest_delay()
+
+class FakeInteraction:
+    def __init__(self, client: "FakeClient", user: FakeUser, message: FakeMessage | None = None):
+        self.client = client
+        self.user = user
+        self.guild_id = 1
+        self.message = message
+        self.channel_id = message.channel.id if message else None
+        self.response = FakeResponse()
+        self.followup = FakeFollowup()
+
+class FakeImageServer:
+    """画像URLの事前確認用のローカルHTTP。/img/{name}.png は Range 対応の PNG、/big.png は巨大、/404.png は 404。"""
+    def __init__(self, image_bytes: int = 200_000):
+        png = b"\x89PNG\r\n\x1a\n" + struct.pack(">I", 13) + b"IHDR" + struct.pack(">II", 640, 480) + b"\x08\x06\x00\x00\x00"
+        self.png = png + b"\x00" * (image_bytes - len(png))
+        self.requests = 0
+        self.runner: web.AppRunner | None = None
+        self.base = ""
+
+    async def _image(self, request: web.Request):
+        self.requests += 1
+        await _rest_delay()
+        body = self.png
+        if request.path == "/big.png":
+            body = self.png + b"\x00" * (64 * 1024 * 1024)
+        rng = request.http_range
+        start, stop = rng.start or 0, min(rng.stop or len(body), len(body))
+        if request.headers.get("Range"):
+            return web.Response(status=206, body=body[start:stop], content_type="image/png",
+                                headers={"Content-Range": f"bytes {start}-{stop - 1}/{len(body)}"})
+        return web.Response(body=body, content_type="image/png")
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/img/{name}", self._image)
+        app.router.add_get("/big.png", self._image)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base = f"http://127.0.0.1:{port}"
+
+    async def close(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+BOT_USER = FakeUser(1)
+
+class FakeClient:
+    def __init__(self, channels):
+        self.channels = {c.id: c for c in channels}
+        self.user = BOT_USER
+
+    async def fetch_webhook(self, webhook_id: int):
+        await _rest_delay()
+        for c in self.channels.values():
+            for wh in c.hooks:
+                if wh.id == webhook_id:
+                    return wh
+        raise discord.NotFound(_FakeResponse(404), "Unknown Webhook")
+
+    def get_channel(self, channel_id: int):
+        return self.channels.get(channel_id)
+
+    async def wait_until_ready(self):
+        pass
+
+# ========= 計測 =========
+def _pct(samples: list[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    s = sorted(samples)
+    return s[min(len(s) - 1, int(q * len(s)))]
+
+def _kv_bytes_written() -> float:
+    return bot.metrics.counters.get(("kv_bytes_written_total", ()), 0)
+
+async def _measure(name: str, n: int, op) -> dict:
+    """op(i) を n 回順に実行し、結果を1行で出す。"""
+    await bot.kv_flush()
+    written0 = _kv_bytes_written()
+    lat = []
+    t0 = time.perf_counter()
+    for i in range(n):
+        s = time.perf_counter()
+        await op(i)
+        lat.append(time.perf_counter() - s)
+    elapsed = time.perf_counter() - t0
+    await bot.kv_flush()
+    row = {
+        "workload": name,
+        "ops": n,
+        "ops_per_sec": n / elapsed if elapsed else 0.0,
+        "p50_ms": _pct(lat, 0.50) * 1000,
+        "p99_ms": _pct(lat, 0.99) * 1000,
+        "kv_bytes_written": int(_kv_bytes_written() - written0),
+    }
+    print(
+        f"{name:<12} ops={n:<6} {row['ops_per_sec']:>9.1f} ops/s  p50={row['p50_ms']:.2f}ms  "
+        f"p99={row['p99_ms']:.2f}ms  kv_written={row['kv_bytes_written']:,}B"
+    )
+    return row
+
+# ========= ワークロード =========
+async def _no_prefix_commands(message):
+    pass
+
+BOARD_ID, LOG_ID, AUTODEL_ID, PURGE_ID = 1001, 1002, 1003, 1004
+
+async def seed_posts(n: int):
+    """過去の投稿記録を n 件入れておく（ストアが大きいときの挙動を見る）。"""
+    chunk = {}
+    for _ in range(n):
+        mid = next(_ids)
+        chunk[bot.gkey_postmap(mid)] = bot.PostRecord(
+            message_id=mid, channel_id=BOARD_ID, author_id=7, author_name="seed#0",
+            author_display="seed", anon_display="0",
+        ).encode()
+        if len(chunk) >= 5000:
+            await bot.kv_set_many(chunk)
+            chunk = {}
+    await bot.kv_set_many(chunk)
+    await bot.kv_flush()
+
+async def run(args) -> list[dict]:
+    board, logch, autodel, purge = (FakeTextChannel(i) for i in (BOARD_ID, LOG_ID, AUTODEL_ID, PURGE_ID))
+    client = FakeClient([board, logch, autodel, purge])
+    bot.bot.get_channel = client.get_channel  # repost_panel / スケジューラが bot を直接見る箇所用
+    bot.bot.process_commands = _no_prefix_commands  # プレフィックスコマンドは未定義（偽メッセージは Context を作れない）
+    approver = FakeUser(next(iter(bot.ALLOWED_USER_IDS)))
+    poster = FakeUser(42)
+    images = FakeImageServer()
+    await images.start()
+
+    if args.seed_posts:
+        t = time.perf_counter()
+        await seed_posts(args.seed_posts)
+        print(f"seeded {args.seed_posts:,} posts in {time.perf_counter() - t:.2f}s")
+
+    await bot.set_channel_config(BOARD_ID, "log_channel_id", LOG_ID)
+    await bot.set_channel_config(AUTODEL_ID, "autodel_sec", 3600)
+    if args.webhook:
+        await bot.enable_board_webhook(client, board)
+    if args.log_digest:
+        await bot.set_channel_config(LOG_ID, "log_digest_sec", args.log_digest)
+    await bot.load_channel_configs()
+    results = []
+
+    async def post(i):
+        modal = bot.PostModal(BOARD_ID, is_anonymous=True)
+        modal.content._value = f"bench post {i}"
+        modal.img_url._value = f"{images.base}/img/{i}.png" if i % args.image_every == 0 else ""
+        await modal.on_submit(FakeInteraction(client, poster))
+    results.append(await _measure("post", args.ops, post))
+
+    await bot.log_digest.flush_all()
+    log_entries = sum(len(m.embeds) for m in logch.messages.values() if m.view is None)
+    print(f"  log messages={sum(1 for m in logch.messages.values() if m.view is None)} entries={log_entries}")
+    cards = [m for m in logch.messages.values() if m.view is not None]
+    first = bot.PendingRecord.decode(cards[0].id, await bot.kv_get(bot.gkey_pending(cards[0].id))) if cards else None
+    print(f"  image cards={len(cards)} probe_requests={images.requests} meta={first.img_meta if first else '-'} "
+          f"via_webhook={sum(1 for m in board.messages.values() if m.author.id != poster.id)}")
+
+    # 画像の事前確認: 毎回別URL（取得あり）と同じURL（キャッシュ）
+    async def probe_cold(i):
+        await bot.image_prober.probe(f"{images.base}/img/cold{i}.png")
+    results.append(await _measure("probe_cold", args.ops, probe_cold))
+
+    async def probe_cached(i):
+        await bot.image_prober.probe(f"{images.base}/img/cold{i % 10}.png")
+    results.append(await _measure("probe_cached", args.ops, probe_cached))
+    big = await bot.image_prober.probe(f"{images.base}/big.png")
+    missing = await bot.image_prober.probe(f"{images.base}/404.png")
+    print(f"  big: ok={big.ok} {big.error}  missing: ok={missing.ok} {missing.error}")
+    half = len(cards) // 2
+
+    async def approve(i):
+        await bot.ApproveButton(BOARD_ID).callback(FakeInteraction(client, approver, cards[i]))
+    results.append(await _measure("approve", half, approve))
+
+    async def reject(i):
+        await bot.RejectButton(BOARD_ID).callback(FakeInteraction(client, approver, cards[half + i]))
+    results.append(await _measure("reject", len(cards) - half, reject))
+
+    async def on_message(i):
+        msg = FakeMessage(autodel)
+        autodel.messages[msg.id] = msg
+        await bot.on_message(msg)
+    results.append(await _measure("on_message", args.ops, on_message))
+
+    # 定期掃除: 古いメッセージを入れて、空になるまで回す
+    old = discord.utils.utcnow() - datetime.timedelta(days=2)
+    base = discord.utils.time_snowflake(old)
+    for i in range(args.purge_messages):
+        m = FakeMessage(purge, msg_id=base + i)
+        purge.messages[m.id] = m
+    cycles = -(-args.purge_messages // args.purge_batch)
+
+    async def purge_cycle(i):
+        await bot._purge_once(purge, 1, args.purge_batch)
+    results.append(await _measure("purge", cycles, purge_cycle))
+    if purge.messages:
+        print(f"  purge left {len(purge.messages)} messages")
+
+    # 書き出し: 投稿記録すべて＋本文（履歴をページごとに取得）
+    exported = []
+
+    async def export(i):
+        exported.append(await bot.export_board(client, BOARD_ID, with_content=True))
+    results.append(await _measure("export", 1, export))
+    resumed = await bot.export_board(client, BOARD_ID, with_content=True)
+    print(f"  exported={exported[0]:,} resumed={resumed} file={os.path.getsize(bot.export_path(BOARD_ID)):,}B")
+
+    await bot.image_prober.close()
+    await images.close()
+    await bot.kv_close()
+    return results
+
+def main():
+    global bot, REST_LATENCY
+    p = argparse.ArgumentParser(description="bot.py offline benchmark")
+    p.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    p.add_argument("--seed-posts", type=int, default=10000, help="事前に入れておく投稿記録の件数（〜100000）")
+    p.add_argument("--ops", type=int, default=1000, help="投稿・on_message の回数")
+    p.add_argument("--image-every", type=int, default=4, help="N件に1件を画像付き（承認カード）にする")
+    p.add_argument("--purge-messages", type=int, default=2000)
+    p.add_argument("--purge-batch", type=int, default=200)
+    p.add_argument("--log-digest", type=int, default=0, help="投稿ログをまとめて送る間隔（秒、0で毎回送信）")
+    p.add_argument("--webhook", action="store_true", help="掲示板への投稿を Webhook 経由にする")
+    p.add_argument("--latency-ms", type=float, default=0.0, help="偽RESTの1呼び出しあたりの遅延")
+    p.add_argument("--json", dest="json_out", help="結果をJSONで保存するパス")
+    args = p.parse_args()
+    REST_LATENCY = args.latency_ms / 1000
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    json_out = os.path.abspath(args.json_out) if args.json_out else None
+    workdir = tempfile.mkdtemp(prefix="anonboard-bench-")
+    os.chdir(workdir)  # bot_kv.json などは作業ディレクトリに作られる
+    os.environ["KV_BACKEND"] = args.backend
+    os.environ.setdefault("PANEL_REPOST_DELAY", "0.05")
+    os.environ.setdefault("PANEL_REPOST_MAX_DELAY", "0.2")
+    os.environ.setdefault("PURGE_SINGLE_DELETE_RATE", "100000")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("IMAGE_PROBE_ALLOW_PRIVATE", "1")  # 画像はローカルの FakeImageServer から
+    sys.path.insert(0, here)
+    bot = importlib.import_module("bot")
+
+    print(f"backend={args.backend} workdir={workdir}")
+    results = asyncio.run(run(args))
+    for path in (bot.DB_PATH, bot.KV_SQLITE_PATH):
+        if os.path.exists(path):
+            print(f"store file {path}: {os.path.getsize(path):,} bytes")
+    if json_out:
+        with open(json_out, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
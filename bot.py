@@ -1,673 +1,3176 @@
-import os
-import sys
-import json
-import re
-import asyncio
-import logging
-import datetime
-
-import discord
-from discord.ext import commands
-from discord import app_commands
-
-# ========= 環境変数 =========
-DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")  # 必須（Railway Variables で設定）
-LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
-# ギルド即時反映用：複数サーバならカンマ区切りで指定可。未設定なら例のIDを既定値に。
-GUILD_IDS = [int(x.strip()) for x in os.getenv("GUILD_IDS", "1398607685158440991").split(",") if x.strip().isdigit()]
-PRIMARY_GUILD_ID = GUILD_IDS[0] if GUILD_IDS else 1398607685158440991
-
-# ========= ログ =========
-logging.basicConfig(
-    level=getattr(logging, LOG_LEVEL, logging.INFO),
-    format="(%(asctime)s) [%(levelname)s] %(name)s: %(message)s",
-)
-log = logging.getLogger("bot")
-
-# ========= 簡易KV(JSON) =========
-DB_PATH = "bot_kv.json"
-_db_lock = asyncio.Lock()
-
-def _kv_load() -> dict:
-    if not os.path.exists(DB_PATH):
-        return {}
-    try:
-        with open(DB_PATH, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return {}
-
-def _kv_save(data: dict):
-    tmp = DB_PATH + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False)
-    os.replace(tmp, DB_PATH)
-
-async def kv_set(key: str, value: str):
-    async with _db_lock:
-        data = _kv_load()
-        data[key] = value
-        _kv_save(data)
-
-async def kv_get(key: str) -> str | None:
-    async with _db_lock:
-        data = _kv_load()
-        return data.get(key)
-
-async def kv_del(key: str):
-    async with _db_lock:
-        data = _kv_load()
-        if key in data:
-            del data[key]
-            _kv_save(data)
-
-async def kv_all() -> dict:
-    async with _db_lock:
-        return _kv_load()
-
-# ========= 権限/設定 =========
-ALLOWED_USER_IDS = {716667546241335328, 440893662701027328}
-
-def is_allowed_user(user: discord.abc.User) -> bool:
-    return user.id in ALLOWED_USER_IDS
-
-async def guard_allowed(interaction: discord.Interaction) -> bool:
-    if not is_allowed_user(interaction.user):
-        await interaction.response.send_message("この操作を行えるのは許可ユーザーだけです。", ephemeral=True)
-        return False
-    return True
-
-# ========= 掲示板用 KVキー =========
-PANEL_KEY    = "anonboard:panel:{channel_id}"
-COUNTER_KEY  = "anonboard:counter:{channel_id}"
-LOGCHAN_KEY  = "anonboard:logchan:{channel_id}"
-POSTMAP_KEY  = "anonboard:post:{message_id}"      # 公開メッセージID -> 投稿者情報(JSON)
-PENDING_KEY  = "anonboard:pending:{log_msg_id}"   # 承認待ちログメッセージID -> 申請情報(JSON)
-AUTODEL_KEY  = "anonboard:autodel_sec:{channel_id}"  # 送信後◯秒削除（新規のみ）
-
-def gkey_panel(chid: int) -> str:       return PANEL_KEY.format(channel_id=chid)
-def gkey_counter(chid: int) -> str:     return COUNTER_KEY.format(channel_id=chid)
-def gkey_logchan(chid: int) -> str:     return LOGCHAN_KEY.format(channel_id=chid)
-def gkey_postmap(mid: int) -> str:      return POSTMAP_KEY.format(message_id=mid)
-def gkey_pending(log_mid: int) -> str:  return PENDING_KEY.format(log_msg_id=log_mid)
-def gkey_autodel(chid: int) -> str:     return AUTODEL_KEY.format(channel_id=chid)
-
-# （後方互換）昔のキーを書き換えた場合に備える
-PENDING_KEY_LEGACY = "anonboard:pending:{message_id}"
-def gkey_pending_legacy(log_mid: int) -> str:
-    return PENDING_KEY_LEGACY.format(message_id=log_mid)
-
-# ========= 定期掃除（掲示板と無関係） =========
-PURGE_KEY = "cleaner:purge:{channel_id}"  # JSON: {"interval": int, "keep_hours": int, "batch_limit": int}
-def gkey_purge(chid: int) -> str: return PURGE_KEY.format(channel_id=chid)
-_purge_tasks: dict[int, asyncio.Task] = {}
-
-async def _run_purge(channel: discord.TextChannel, interval_sec: int, keep_hours: int, batch_limit: int):
-    """掲示板とは無関係の定期掃除。ピン留め以外を削除。"""
-    while True:
-        try:
-            await asyncio.sleep(interval_sec)
-            cutoff = discord.utils.utcnow() - datetime.timedelta(hours=keep_hours)
-
-            to_delete_bulk, to_delete_single = [], []
-            async for msg in channel.history(limit=1000, oldest_first=False):
-                if len(to_delete_bulk) + len(to_delete_single) >= batch_limit:
-                    break
-                if msg.pinned:
-                    continue
-                if msg.created_at >= cutoff:
-                    continue
-
-                # 14日以内: bulk / 超過: 個別
-                if (discord.utils.utcnow() - msg.created_at) <= datetime.timedelta(days=14):
-                    to_delete_bulk.append(msg)
-                else:
-                    to_delete_single.append(msg)
-
-            if to_delete_bulk:
-                try:
-                    await channel.delete_messages(to_delete_bulk)
-                except Exception:
-                    # 権限/件数などで失敗したら個別に
-                    for m in to_delete_bulk:
-                        try:
-                            await m.delete()
-                        except Exception:
-                            pass
-
-            for m in to_delete_single:
-                try:
-                    await m.delete()
-                except Exception:
-                    pass
-
-            if to_delete_bulk or to_delete_single:
-                log.info(f"[purge] channel={channel.id} deleted bulk={len(to_delete_bulk)} single={len(to_delete_single)} (<{keep_hours}h)")
-
-        except asyncio.CancelledError:
-            break
-        except Exception as e:
-            log.exception(f"[purge] error in channel {channel.id}: {e}")
-            continue
-
-async def start_purge_for_channel(bot: commands.Bot, channel_id: int, interval_sec: int, keep_hours: int, batch_limit: int):
-    await stop_purge_for_channel(channel_id)
-    ch = bot.get_channel(channel_id)
-    if not isinstance(ch, discord.TextChannel):
-        return
-    t = asyncio.create_task(_run_purge(ch, interval_sec, keep_hours, batch_limit))
-    _purge_tasks[channel_id] = t
-
-async def stop_purge_for_channel(channel_id: int):
-    t = _purge_tasks.pop(channel_id, None)
-    if t and not t.done():
-        t.cancel()
-        try:
-            await t
-        except Exception:
-            pass
-
-# ========= URL/メッセージリンク 解析 =========
-IMAGE_EXT_RE = re.compile(r"\.(?:png|jpg|jpeg|gif|webp)(?:\?.*)?$", re.IGNORECASE)
-URL_RE = re.compile(r"https?://[^\s]+", re.IGNORECASE)
-
-def is_image_url(url: str) -> bool:
-    if IMAGE_EXT_RE.search(url):
-        return True
-    cdn_like = ("cdn.discordapp.com", "media.discordapp.net", "images-ext", "pbs.twimg.com", "imgur.com")
-    return any(h in url for h in cdn_like)
-
-def extract_first_image_url(text: str) -> str | None:
-    for m in URL_RE.findall(text or ""):
-        if is_image_url(m):
-            return m
-    return None
-
-MSG_LINK_RE = re.compile(
-    r"https?://(?:ptb\.|canary\.)?discord\.com/channels/(?P<guild_id>\d+)/(?P<channel_id>\d+)/(?P<message_id>\d+)"
-)
-
-async def fetch_message_from_link(bot: commands.Bot, link: str) -> discord.Message | None:
-    m = MSG_LINK_RE.match(link.strip())
-    if not m:
-        return None
-    ch_id = int(m.group("channel_id"))
-    msg_id = int(m.group("message_id"))
-    ch = bot.get_channel(ch_id)
-    if not isinstance(ch, (discord.TextChannel, discord.Thread)):
-        return None
-    try:
-        return await ch.fetch_message(msg_id)
-    except Exception:
-        return None
-
-# ========= Discord =========
-intents = discord.Intents.default()
-intents.message_content = True
-intents.guilds = True
-
-bot = commands.Bot(command_prefix="!", intents=intents)
-tree = bot.tree
-
-# ========= 匿名掲示板 UI =========
-class PostModal(discord.ui.Modal, title="投稿内容を入力"):
-    """画像付き: 本文は即時公開・画像はログ承認後に追記。画像なし: 即時公開＋ログ記録。"""
-    def __init__(self, channel_id: int, is_anonymous: bool):
-        super().__init__(timeout=180)
-        self.channel_id = channel_id
-        self.is_anonymous = is_anonymous
-        self.content = discord.ui.TextInput(
-            label="本文", style=discord.TextStyle.paragraph,
-            placeholder="ここにメッセージを入力", max_length=2000, required=True
-        )
-        self.add_item(self.content)
-        self.img_url = discord.ui.TextInput(
-            label="画像URL（任意・画像は承認後に反映）", style=discord.TextStyle.short,
-            placeholder="https://...", max_length=500, required=False
-        )
-        self.add_item(self.img_url)
-
-    async def on_submit(self, interaction: discord.Interaction):
-        await interaction.response.defer(ephemeral=True, thinking=False)
-
-        board_ch = interaction.client.get_channel(self.channel_id)
-        if board_ch is None or not isinstance(board_ch, discord.TextChannel):
-            return await interaction.followup.send("対象チャンネルが見つかりません。", ephemeral=True)
-
-        # 表示名（匿名は連番）
-        if self.is_anonymous:
-            counter_s = await kv_get(gkey_counter(self.channel_id))
-            counter = int(counter_s) if counter_s and counter_s.isdigit() else 0
-            counter += 1
-            await kv_set(gkey_counter(self.channel_id), str(counter))
-            display_name = f"{counter}"
-        else:
-            display_name = interaction.user.display_name
-
-        content = self.content.value.strip()
-        if not content:
-            return await interaction.followup.send("本文が空です。", ephemeral=True)
-
-        # 画像URL抽出（承認フローへ）
-        img = (self.img_url.value or "").strip()
-        if not img:
-            img = extract_first_image_url(content) or ""
-        img = img.strip()
-        has_image = bool(img)
-
-        # 本文だけ公開
-        embed = discord.Embed(description=content, color=discord.Color.blurple())
-        embed.set_footer(text=f"投稿者: {display_name}")
-        published = await board_ch.send(embed=embed)
-
-        # 公開マッピング保存（reveal用）
-        post_info = {
-            "guild_id": interaction.guild_id,
-            "channel_id": self.channel_id,
-            "message_id": published.id,
-            "anonymous": self.is_anonymous,
-            "anon_display": display_name if self.is_anonymous else None,
-            "author_id": interaction.user.id,
-            "author_name": str(interaction.user),
-            "author_display": interaction.user.display_name,
-            "img_url": None,
-        }
-        await kv_set(gkey_postmap(published.id), json.dumps(post_info, ensure_ascii=False))
-
-        # ログ送信（画像なしでも送る）
-        log_chan_id_s = await kv_get(gkey_logchan(self.channel_id))
-        log_ch = interaction.client.get_channel(int(log_chan_id_s)) if (log_chan_id_s and log_chan_id_s.isdigit()) else None
-
-        if not has_image:
-            if isinstance(log_ch, discord.TextChannel):
-                le = discord.Embed(title="📝 投稿ログ（画像なし）", description=content, color=discord.Color.dark_gray())
-                le.add_field(name="匿名？", value="はい" if self.is_anonymous else "いいえ", inline=True)
-                le.add_field(name="表示名", value=display_name, inline=True)
-                le.add_field(name="投稿先", value=f"<#{self.channel_id}>", inline=True)
-                le.add_field(name="本文メッセージ", value=f"[ジャンプ]({published.jump_url})", inline=False)
-                le.add_field(name="送信者", value=f"{interaction.user.mention} ({interaction.user.id})", inline=False)
-                await log_ch.send(embed=le)
-            await repost_panel(interaction.client, board_ch.id)
-            return
-
-        # 画像あり → 承認カード
-        if not isinstance(log_ch, discord.TextChannel):
-            await interaction.followup.send(
-                "画像は承認制ですが、ログチャンネルが未設定のため画像は反映できませんでした（本文は公開済み）。\n"
-                "管理者に /board setlog で設定してもらってください。",
-                ephemeral=True
-            )
-            await repost_panel(interaction.client, board_ch.id)
-            return
-
-        pending = discord.Embed(title="🕒 画像承認リクエスト", description=content, color=discord.Color.orange())
-        pending.add_field(name="匿名？", value="はい" if self.is_anonymous else "いいえ", inline=True)
-        pending.add_field(name="表示名", value=display_name, inline=True)
-        pending.add_field(name="投稿先", value=f"<#{self.channel_id}>", inline=True)
-        pending.add_field(name="本文メッセージ", value=f"[ジャンプ]({published.jump_url})", inline=False)
-        pending.add_field(name="送信者", value=f"{interaction.user.mention} ({interaction.user.id})", inline=False)
-        pending.set_image(url=img)
-
-        view = ApprovalView()
-        log_msg = await log_ch.send(embed=pending, view=view)
-
-        pending_info = {
-            "guild_id": interaction.guild_id,
-            "board_channel_id": self.channel_id,
-            "board_message_id": published.id,
-            "log_message_id": log_msg.id,
-            "anonymous": self.is_anonymous,
-            "anon_display": display_name if self.is_anonymous else None,
-            "author_id": interaction.user.id,
-            "author_name": str(interaction.user),
-            "author_display": interaction.user.display_name,
-            "content": content,
-            "img_url": img
-        }
-        await kv_set(gkey_pending(log_msg.id), json.dumps(pending_info, ensure_ascii=False))
-        await repost_panel(interaction.client, board_ch.id)
-
-class ApprovalView(discord.ui.View):
-    def __init__(self):
-        super().__init__(timeout=None)
-
-    @discord.ui.button(label="Approve", style=discord.ButtonStyle.success, emoji="✅")
-    async def approve(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if not is_allowed_user(interaction.user):
-            return await interaction.response.send_message("承認権限がありません。", ephemeral=True)
-
-        pending_s = await kv_get(gkey_pending(interaction.message.id))
-        if not pending_s:
-            pending_s = await kv_get(gkey_pending_legacy(interaction.message.id))
-            if pending_s:
-                await kv_set(gkey_pending(interaction.message.id), pending_s)
-                await kv_del(gkey_pending_legacy(interaction.message.id))
-        if not pending_s:
-            return await interaction.response.send_message("承認待ち情報が見つかりません。", ephemeral=True)
-
-        info = json.loads(pending_s)
-        board_ch = interaction.client.get_channel(int(info["board_channel_id"]))
-        if not isinstance(board_ch, discord.TextChannel):
-            return await interaction.response.send_message("投稿先チャンネルが見つかりません。", ephemeral=True)
-        try:
-            target_msg = await board_ch.fetch_message(int(info["board_message_id"]))
-        except Exception:
-            return await interaction.response.send_message("本文メッセージが取得できませんでした。", ephemeral=True)
-
-        if target_msg.embeds:
-            base = target_msg.embeds[0]
-            new_embed = discord.Embed(description=base.description or info["content"], color=discord.Color.blurple())
-        else:
-            new_embed = discord.Embed(description=info["content"], color=discord.Color.blurple())
-        display_name = info["anon_display"] if info["anonymous"] else info["author_display"]
-        new_embed.set_footer(text=f"投稿者: {display_name}")
-        if info.get("img_url"):
-            new_embed.set_image(url=info["img_url"])
-        await target_msg.edit(embed=new_embed)
-
-        post_s = await kv_get(gkey_postmap(target_msg.id))
-        if post_s:
-            post = json.loads(post_s)
-            post["img_url"] = info.get("img_url")
-            await kv_set(gkey_postmap(target_msg.id), json.dumps(post, ensure_ascii=False))
-
-        new_log_embed = interaction.message.embeds[0]
-        new_log_embed.title = "✅ 承認・反映済み"
-        new_log_embed.color = discord.Color.green()
-        for child in self.children:
-            child.disabled = True
-        await interaction.message.edit(embed=new_log_embed, view=self)
-
-        await kv_del(gkey_pending(interaction.message.id))
-        await kv_del(gkey_pending_legacy(interaction.message.id))
-        await interaction.response.send_message("承認して掲示板に画像を反映しました。", ephemeral=True)
-
-    @discord.ui.button(label="Reject", style=discord.ButtonStyle.danger, emoji="🛑")
-    async def reject(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if not is_allowed_user(interaction.user):
-            return await interaction.response.send_message("承認権限がありません。", ephemeral=True)
-
-        pending_s = await kv_get(gkey_pending(interaction.message.id))
-        if not pending_s:
-            pending_s = await kv_get(gkey_pending_legacy(interaction.message.id))
-            if pending_s:
-                await kv_set(gkey_pending(interaction.message.id), pending_s)
-                await kv_del(gkey_pending_legacy(interaction.message.id))
-        if not pending_s:
-            return await interaction.response.send_message("承認待ち情報が見つかりません。", ephemeral=True)
-
-        new_log_embed = interaction.message.embeds[0]
-        new_log_embed.title = "⛔ 実施せず（本文は公開済み）"
-        new_log_embed.color = discord.Color.red()
-        for child in self.children:
-            child.disabled = True
-        await interaction.message.edit(embed=new_log_embed, view=self)
-
-        await kv_del(gkey_pending(interaction.message.id))
-        await kv_del(gkey_pending_legacy(interaction.message.id))
-        await interaction.response.send_message("却下しました（本文は公開済みのまま）。", ephemeral=True)
-
-class BoardView(discord.ui.View):
-    def __init__(self, channel_id: int):
-        super().__init__(timeout=None)
-        self.channel_id = channel_id
-
-    @discord.ui.button(label="匿名で投稿", style=discord.ButtonStyle.primary, emoji="🕵️")
-    async def post_anon(self, interaction: discord.Interaction, button: discord.ui.Button):
-        await interaction.response.send_modal(PostModal(self.channel_id, is_anonymous=True))
-
-async def repost_panel(client: commands.Bot, channel_id: int):
-    """古いパネルを削除 → 新しいパネルを最下部に再掲してID保存"""
-    panel_key = gkey_panel(channel_id)
-    panel_id_s = await kv_get(panel_key)
-    channel = client.get_channel(channel_id)
-    if channel is None or not isinstance(channel, discord.TextChannel):
-        return
-
-    if panel_id_s and panel_id_s.isdigit():
-        try:
-            old = await channel.fetch_message(int(panel_id_s))
-            await old.delete()
-        except Exception:
-            pass
-
-    view = BoardView(channel_id)
-    msg = await channel.send("**匿名掲示板パネル**\n下のボタンから投稿してください。", view=view)
-    await kv_set(panel_key, str(msg.id))
-
-# ---- スラッシュグループ（子コマンドに guild 指定は付けない）----
-board_group = app_commands.Group(name="board", description="匿名掲示板の設定/操作")
-
-@board_group.command(name="setup", description="このチャンネル（または指定先）に掲示板パネルを設置")
-@app_commands.describe(
-    channel="掲示板にするテキストチャンネル（未指定ならこのチャンネル）",
-    reset_counter="匿名連番を0から再開",
-    log_channel="投稿ログ送信先（画像承認用・推奨）"
-)
-async def board_setup(
-    interaction: discord.Interaction,
-    channel: discord.TextChannel | None = None,
-    reset_counter: bool = False,
-    log_channel: discord.TextChannel | None = None
-):
-    if not await guard_allowed(interaction):
-        return
-    target = channel or interaction.channel
-    if not isinstance(target, discord.TextChannel):
-        return await interaction.response.send_message("テキストチャンネルで実行してください。", ephemeral=True)
-    if reset_counter:
-        await kv_set(gkey_counter(target.id), "0")
-    if log_channel:
-        await kv_set(gkey_logchan(target.id), str(log_channel.id))
-    await repost_panel(interaction.client, target.id)
-    txt = f"掲示板パネルを設置しました：{target.mention}\n"
-    if log_channel: txt += f"投稿ログ（承認用）：{log_channel.mention}\n"
-    if reset_counter: txt += "匿名連番をリセットしました。"
-    await interaction.response.send_message(txt, ephemeral=True)
-
-@board_group.command(name="setlog", description="掲示板の投稿ログ先を設定（画像承認用）")
-@app_commands.describe(board_channel="掲示板チャンネル（未指定なら実行場所）", log_channel="ログ送信先")
-async def board_setlog(
-    interaction: discord.Interaction,
-    board_channel: discord.TextChannel | None = None,
-    log_channel: discord.TextChannel | None = None
-):
-    if not await guard_allowed(interaction):
-        return
-    target = board_channel or interaction.channel
-    if not isinstance(target, discord.TextChannel) or not log_channel:
-        return await interaction.response.send_message("対象/ログ先はテキストチャンネルを指定してください。", ephemeral=True)
-    await kv_set(gkey_logchan(target.id), str(log_channel.id))
-    await interaction.response.send_message(f"{target.mention} の投稿ログ先を {log_channel.mention} に設定しました。", ephemeral=True)
-
-@board_group.command(name="reset_counter", description="匿名連番を0にリセット")
-@app_commands.describe(channel="対象チャンネル（未指定なら実行場所）")
-async def board_reset_counter(interaction: discord.Interaction, channel: discord.TextChannel | None = None):
-    if not await guard_allowed(interaction):
-        return
-    target = channel or interaction.channel
-    if not isinstance(target, discord.TextChannel):
-        return await interaction.response.send_message("テキストチャンネルで実行してください。", ephemeral=True)
-    await kv_set(gkey_counter(target.id), "0")
-    await interaction.response.send_message(f"匿名連番をリセットしました：{target.mention}", ephemeral=True)
-
-@board_group.command(name="panel", description="パネルを最下部に再掲")
-@app_commands.describe(channel="対象チャンネル（未指定なら実行場所）")
-async def board_panel(interaction: discord.Interaction, channel: discord.TextChannel | None = None):
-    if not await guard_allowed(interaction):
-        return
-    target = channel or interaction.channel
-    if not isinstance(target, discord.TextChannel):
-        return await interaction.response.send_message("テキストチャンネルで実行してください。", ephemeral=True)
-    await repost_panel(interaction.client, target.id)
-    await interaction.response.send_message(f"パネルを再掲しました：{target.mention}", ephemeral=True)
-
-@board_group.command(name="reveal", description="匿名投稿の実投稿者を照会（指定ユーザーのみ）")
-@app_commands.describe(message_link="対象メッセージのリンク（右クリック→リンクをコピー）")
-async def board_reveal(interaction: discord.Interaction, message_link: str):
-    if not await guard_allowed(interaction):
-        return
-    msg = await fetch_message_from_link(interaction.client, message_link)
-    if not msg:
-        return await interaction.response.send_message("メッセージリンクが無効です。正しいリンクを指定してください。", ephemeral=True)
-    data_s = await kv_get(gkey_postmap(msg.id))
-    if not data_s:
-        return await interaction.response.send_message("このメッセージの記録が見つかりません。匿名掲示板の投稿ではない可能性があります。", ephemeral=True)
-    info = json.loads(data_s)
-    desc = (
-        f"**匿名？** {'はい' if info.get('anonymous') else 'いいえ'}\n"
-        f"**匿名表示名**: {info.get('anon_display') or '-'}\n"
-        f"**実投稿者**: <@{info.get('author_id')}> (`{info.get('author_name')}` / 表示名: `{info.get('author_display')}`)\n"
-        f"**メッセージ**: {msg.jump_url}"
-    )
-    await interaction.response.send_message(desc, ephemeral=True)
-
-# ---- 送信後◯秒で削除（新規のみ） ----
-@board_group.command(name="autodel_start", description="このチャンネルで新規メッセージを自動削除します")
-@app_commands.describe(seconds="削除までの秒数（10〜604800）")
-async def board_autodel_start(interaction: discord.Interaction, seconds: app_commands.Range[int, 10, 604800]):
-    if not await guard_allowed(interaction):
-        return
-    await kv_set(gkey_autodel(interaction.channel_id), str(int(seconds)))
-    await interaction.response.send_message(
-        f"このチャンネルの新規メッセージを **{int(seconds)}秒後** に自動削除します。\n"
-        "※ ピン留めと掲示板パネルは削除対象外です。",
-        ephemeral=True
-    )
-
-@board_group.command(name="autodel_stop", description="このチャンネルの自動削除を停止します")
-async def board_autodel_stop(interaction: discord.Interaction):
-    if not await guard_allowed(interaction):
-        return
-    await kv_del(gkey_autodel(interaction.channel_id))
-    await interaction.response.send_message("このチャンネルの自動削除を **停止** しました。", ephemeral=True)
-
-# ---- トップレベル：掲示板とは無関係の定期掃除コマンド（ギルド即時反映）----
-def guild_only_deco(func):
-    # 複数ギルド対応（環境変数 GUILD_IDS に列挙）
-    return app_commands.guilds(*[discord.Object(id=g) for g in (GUILD_IDS or [PRIMARY_GUILD_ID])])(func)
-
-@tree.command(name="purge_start", description="一定間隔で古い履歴を定期削除（掲示板とは無関係）")
-@guild_only_deco
-@app_commands.describe(
-    interval_seconds="実行間隔（60〜86400秒）",
-    keep_hours="保存期間（1〜720時間：これより古いメッセージを削除）",
-    batch_limit="1回の最大削除数（10〜1000、既定200）"
-)
-async def purge_start(
-    interaction: discord.Interaction,
-    interval_seconds: app_commands.Range[int, 60, 86400],
-    keep_hours: app_commands.Range[int, 1, 720],
-    batch_limit: app_commands.Range[int, 10, 1000] = 200
-):
-    # Botの権限チェック
-    me = interaction.guild.me if interaction.guild else None
-    if not (me and interaction.channel.permissions_for(me).manage_messages):
-        return await interaction.response.send_message("ボットに **メッセージの管理** 権限が必要です。", ephemeral=True)
-
-    cfg = {"interval": int(interval_seconds), "keep_hours": int(keep_hours), "batch_limit": int(batch_limit)}
-    await kv_set(gkey_purge(interaction.channel_id), json.dumps(cfg, ensure_ascii=False))
-    await start_purge_for_channel(interaction.client, interaction.channel_id, cfg["interval"], cfg["keep_hours"], cfg["batch_limit"])
-    await interaction.response.send_message(
-        f"✅ 定期掃除を開始しました（掲示板とは無関係）。\n"
-        f"- 実行間隔: **{cfg['interval']}秒**\n"
-        f"- 保存期間: **{cfg['keep_hours']}時間**\n"
-        f"- 1回の上限: **{cfg['batch_limit']}件**",
-        ephemeral=True
-    )
-
-@tree.command(name="purge_stop", description="定期掃除を停止（掲示板とは無関係）")
-@guild_only_deco
-async def purge_stop(interaction: discord.Interaction):
-    await kv_del(gkey_purge(interaction.channel_id))
-    await stop_purge_for_channel(interaction.channel_id)
-    await interaction.response.send_message("⏹️ 定期掃除を停止しました。", ephemeral=True)
-
-# ---- /ping ----
-@tree.command(name="ping", description="生存確認")
-@guild_only_deco
-async def ping(interaction: discord.Interaction):
-    await interaction.response.send_message("Pong! 🏓", ephemeral=True)
-
-# ---- on_message: 送信後◯秒削除のスケジュール ----
-@bot.event
-async def on_message(message: discord.Message):
-    await bot.process_commands(message)
-    if not isinstance(message.channel, discord.TextChannel):
-        return
-    if message.author is None:
-        return
-
-    sec_s = await kv_get(gkey_autodel(message.channel.id))
-    if not sec_s:
-        return
-    try:
-        seconds = int(sec_s)
-    except Exception:
-        return
-    if seconds <= 0:
-        return
-
-    # ピン留めとパネルは削除対象外（掲示板運用上の仕様）
-    if getattr(message, "pinned", False):
-        return
-    panel_id_s = await kv_get(gkey_panel(message.channel.id))
-    if panel_id_s and panel_id_s.isdigit() and int(panel_id_s) == message.id:
-        return
-
-    async def _delete_later(msg: discord.Message, delay: int):
-        try:
-            await asyncio.sleep(delay)
-            await msg.delete()
-        except Exception:
-            pass
-
-    asyncio.create_task(_delete_later(message, seconds))
-
-# ---- ready ----
-@bot.event
-async def on_ready():
-    user_info = "(user: None)" if bot.user is None else f"{bot.user} (ID: {bot.user.id})"
-    log.info(f"Logged in as {user_info}")
-    try:
-        # /board グループの登録（子コマンドに guild 指定は不可なので、ツリー側でまとめて同期）
-        if board_group not in tree.get_commands():
-            tree.add_command(board_group)
-
-        # ギルド同期（即時反映）
-        for gid in GUILD_IDS:
-            await tree.sync(guild=discord.Object(id=gid))
-            log.info(f"Synced commands to guild {gid}")
-    except Exception as e:
-        log.exception("Command sync failed: %s", e)
-
-    # --- 起動時に定期掃除タスクを復元（掲示板とは無関係） ---
-    try:
-        allkv = await kv_all()
-        prefix = "cleaner:purge:"
-        for k, v in allkv.items():
-            if not k.startswith(prefix):
-                continue
-            try:
-                ch_id = int(k.split(":")[-1])
-            except Exception:
-                continue
-            cfg = json.loads(v)
-            interval = int(cfg.get("interval", 600))
-            keep_hours = int(cfg.get("keep_hours", 24))
-            batch_limit = int(cfg.get("batch_limit", 200))
-            await start_purge_for_channel(bot, ch_id, interval, keep_hours, batch_limit)
-            log.info(f"[purge] restored task for channel={ch_id} interval={interval}s keep={keep_hours}h batch={batch_limit}")
-    except Exception as e:
-        log.exception("restore purge failed: %s", e)
-
-# ---- main ----
-def main():
-    if not DISCORD_TOKEN:
-        log.error("DISCORD_TOKEN が未設定です（Railway Variables で設定してください）")
-        sys.exit(1)
-    bot.run(DISCORD_TOKEN)
-
-if __name__ == "__main__":
-    main()
-
+import os
+import sys
+import json
+import re
+import asyncio
+import logging
+import datetime
+import hashlib
+import bisect
+import heapq
+import random
+import itertools
+import gzip
+import time
+import signal
+import sqlite3
+import tracemalloc
+import struct
+import socket
+import ipaddress
+from urllib.parse import urljoin, urlsplit
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import aiohttp
+import discord
+from discord.ext import commands
+from discord import app_commands
+
+# ========= 環境変数 =========
+DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")  # 必須（Railway Variables で設定）
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# ギルド即時反映用：複数サーバならカンマ区切りで指定可。未設定なら例のIDを既定値に。
+GUILD_IDS = [int(x.strip()) for x in os.getenv("GUILD_IDS", "1398607685158440991").split(",") if x.strip().isdigit()]
+PRIMARY_GUILD_ID = GUILD_IDS[0] if GUILD_IDS else 1398607685158440991
+# シャード分割：SHARD_COUNT を指定すると AutoShardedBot で起動。SHARD_IDS でこのプロセスが受け持つシャードを絞る
+# （複数プロセスに分けるときは KV_BACKEND=sqlite で同じファイルを共有する）
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0") or 0)
+SHARD_IDS = [int(x.strip()) for x in os.getenv("SHARD_IDS", "").split(",") if x.strip().isdigit()]
+
+# ========= ログ =========
+logging.basicConfig(
+    level=getattr(logging, LOG_LEVEL, logging.INFO),
+    format="(%(asctime)s) [%(levelname)s] %(name)s: %(message)s",
+)
+log = logging.getLogger("bot")
+
+# ========= 計測 =========
+# METRICS_FILE: Prometheus 形式のテキストを定期的に書き出すパス / METRICS_PORT: 同じ内容をHTTPで返すポート
+METRICS_FILE = os.getenv("METRICS_FILE", "")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0") or 0)
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", "15"))
+
+class Histogram:
+    """固定バケットのヒストグラム（秒）。分位点はバケット上限で近似する。"""
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    __slots__ = ("counts", "count", "sum", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, v: float):
+        self.counts[bisect.bisect_left(self.BUCKETS, v)] += 1
+        self.count += 1
+        self.sum += v
+        if v > self.max:
+            self.max = v
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return min(self.BUCKETS[i], self.max) if i < len(self.BUCKETS) else self.max
+        return self.max
+
+def _metric_key(name: str, labels: dict) -> tuple:
+    return (name, tuple(sorted(labels.items())))
+
+def _metric_name(key: tuple, suffix: str = "", extra: str = "") -> str:
+    name, labels = key
+    parts = [f'{k}="{v}"' for k, v in labels]
+    if extra:
+        parts.append(extra)
+    return f"{name}{suffix}{{{','.join(parts)}}}" if parts else f"{name}{suffix}"
+
+class Metrics:
+    """ヒストグラム・カウンタ・ゲージ。ラベルはキーワード引数で渡す。"""
+    def __init__(self):
+        self.histograms: dict[tuple, Histogram] = {}
+        self.counters: dict[tuple, float] = {}
+        self.gauges: dict[tuple, float] = {}
+
+    def observe(self, name: str, value: float, **labels):
+        key = _metric_key(name, labels)
+        h = self.histograms.get(key)
+        if h is None:
+            h = self.histograms[key] = Histogram()
+        h.observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _metric_key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        self.gauges[_metric_key(name, labels)] = value
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for key, v in sorted(self.counters.items()):
+            lines.append(f"{_metric_name(key)} {v}")
+        for key, v in sorted(self.gauges.items()):
+            lines.append(f"{_metric_name(key)} {v}")
+        for key, h in sorted(self.histograms.items()):
+            cum = 0
+            for le, c in zip(Histogram.BUCKETS, h.counts):
+                cum += c
+                lines.append(_metric_name(key, "_bucket", 'le="%s"' % le) + f" {cum}")
+            lines.append(_metric_name(key, "_bucket", 'le="+Inf"') + f" {h.count}")
+            lines.append(f"{_metric_name(key, '_sum')} {h.sum}")
+            lines.append(f"{_metric_name(key, '_count')} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary_lines(self) -> list[str]:
+        lines = []
+        for key, h in sorted(self.histograms.items()):
+            lines.append(
+                f"{_metric_name(key)} n={h.count} p50={h.quantile(0.5) * 1000:.1f}ms "
+                f"p99={h.quantile(0.99) * 1000:.1f}ms max={h.max * 1000:.1f}ms"
+            )
+        for key, v in sorted(self.counters.items()):
+            lines.append(f"{_metric_name(key)} = {v:g}")
+        for key, v in sorted(self.gauges.items()):
+            lines.append(f"{_metric_name(key)} = {v:g}")
+        return lines
+
+metrics = Metrics()
+
+def _write_metrics_file(path: str, text: str):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+async def _metrics_file_loop():
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL)
+        try:
+            await asyncio.to_thread(_write_metrics_file, METRICS_FILE, metrics.render_prometheus())
+        except Exception as e:
+            log.warning(f"[metrics] write failed: {e}")
+
+async def _metrics_http_handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        body = metrics.render_prometheus().encode("utf-8")
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("ascii")
+            + body
+        )
+        await writer.drain()
+    except Exception:
+        pass
+    finally:
+        writer.close()
+
+async def start_metrics_exporters():
+    if METRICS_FILE:
+        asyncio.create_task(_metrics_file_loop())
+    if METRICS_PORT:
+        await asyncio.start_server(_metrics_http_handler, "127.0.0.1", METRICS_PORT)
+        log.info(f"[metrics] serving on 127.0.0.1:{METRICS_PORT}")
+
+# ========= 簡易KV =========
+# KV_BACKEND=json（既定: bot_kv.json） / sqlite（KV_SQLITE_PATH、初回起動時に bot_kv.json を取り込み）
+KV_BACKEND = os.getenv("KV_BACKEND", "sqlite" if SHARD_IDS else "json").lower()
+DB_PATH = "bot_kv.json"
+KV_SQLITE_PATH = os.getenv("KV_SQLITE_PATH", "bot_kv.sqlite3")
+KV_SQLITE_BUSY_TIMEOUT = float(os.getenv("KV_SQLITE_BUSY_TIMEOUT", "10"))  # 他プロセスの書き込み中に待つ秒数
+# 書き込みはメモリ上の dict に反映し、この秒数ぶんまとめてからファイルへフラッシュする
+KV_FLUSH_DELAY = float(os.getenv("KV_FLUSH_DELAY", "2.0"))
+# 連番（kv_incr）はこの数ずつ先取りし、先取りした上限だけを小さな別ファイルへ即時に書く。
+# 異常終了すると先取り分の番号は飛ぶが、同じ番号を二度使うことはない。
+KV_COUNTER_BLOCK = int(os.getenv("KV_COUNTER_BLOCK", "100"))
+
+# _kv_load / _kv_save と SQLite の _xxx はワーカースレッドからも呼ばれるので、metrics への記録は
+# 呼び出し側（イベントループ上）で行う（集計 dict をループ側の出力と同時に触らないように）。
+def _kv_load(path: str = DB_PATH) -> dict:
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+def _counters_path(path: str) -> str:
+    return path + ".counters"
+
+def _kv_merge_counters(data: dict, path: str = DB_PATH) -> dict:
+    """連番の先取り上限ファイルを読み、本体より進んでいれば上限から再開する（返り値は上限の dict）。"""
+    try:
+        with open(_counters_path(path), "r", encoding="utf-8") as f:
+            reserved = {k: int(v) for k, v in json.load(f).items()}
+    except (OSError, ValueError, AttributeError):
+        return {}
+    for k, n in reserved.items():
+        cur = data.get(k)
+        if not (cur and cur.isdigit() and int(cur) >= n):
+            data[k] = str(n)
+    return reserved
+
+def _kv_save_counters(reserved: dict, path: str = DB_PATH):
+    target = _counters_path(path)
+    tmp = target + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(reserved, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, target)
+
+def _kv_save(data: dict, path: str = DB_PATH) -> int:
+    """書き出したバイト数を返す。"""
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+        size = f.tell()
+    os.replace(tmp, path)
+    return size
+
+class KVBackend(ABC):
+    """KVストアの共通インターフェース（キー・値とも文字列）。"""
+    @abstractmethod
+    async def get(self, key: str) -> str | None:
+        ...
+
+    @abstractmethod
+    async def set(self, key: str, value: str):
+        ...
+
+    @abstractmethod
+    async def delete(self, key: str):
+        ...
+
+    @abstractmethod
+    async def all(self) -> dict:
+        ...
+
+    @abstractmethod
+    async def incr(self, key: str, delta: int = 1) -> int:
+        """整数値を原子的に加算して新しい値を返す（未設定・数値以外は0扱い）。"""
+        ...
+
+    @abstractmethod
+    async def pop(self, key: str) -> str | None:
+        """値を取り出して削除する。同じキーを取り合ったとき値を受け取るのは1回だけ。"""
+        ...
+
+    @abstractmethod
+    def scan(self, prefix: str, page: int = 500, after: str | None = None):
+        """prefix で始まるキーをキー順に (key, value) で流す非同期イテレータ。after を渡すとそのキーより後から。"""
+        ...
+
+    async def get_many(self, keys) -> dict:
+        out = {}
+        for k in keys:
+            v = await self.get(k)
+            if v is not None:
+                out[k] = v
+        return out
+
+    async def set_many(self, items: dict):
+        for k, v in items.items():
+            await self.set(k, v)
+
+    async def delete_many(self, keys):
+        for k in keys:
+            await self.delete(k)
+
+    async def flush(self):
+        pass
+
+    async def close(self):
+        await self.flush()
+
+class JsonKVBackend(KVBackend):
+    """JSONファイル1つ。メモリ上に保持し、変更はまとめて原子的に書き出す。"""
+    def __init__(self, path: str, flush_delay: float):
+        self.path = path
+        self.flush_delay = flush_delay
+        self._lock = asyncio.Lock()
+        self._flush_lock = asyncio.Lock()
+        self._cache: dict | None = None
+        self._keys: list[str] = []  # 前方一致スキャン用のソート済みキー索引
+        self._dirty = False
+        self._flush_task: asyncio.Task | None = None
+        self._reserved: dict[str, int] = {}   # 連番ごとの先取り上限
+        self._persisted: dict[str, int] = {}  # そのうち counters ファイルに書き終えた値
+        self._counter_lock = asyncio.Lock()
+
+    def _data(self) -> dict:
+        # 初回アクセス時だけファイルを読む
+        if self._cache is None:
+            start = time.perf_counter()
+            self._cache = _kv_load(self.path)
+            if os.path.exists(self.path):
+                metrics.observe("kv_load_seconds", time.perf_counter() - start)
+                metrics.set_gauge("kv_file_bytes", os.path.getsize(self.path))
+            self._reserved = _kv_merge_counters(self._cache, self.path)
+            self._persisted = dict(self._reserved)
+            self._keys = sorted(self._cache)
+        return self._cache
+
+    def _put(self, data: dict, key: str, value: str):
+        if key not in data:
+            bisect.insort(self._keys, key)
+        data[key] = value
+
+    def _pop(self, data: dict, key: str) -> bool:
+        if key not in data:
+            return False
+        del data[key]
+        del self._keys[bisect.bisect_left(self._keys, key)]
+        return True
+
+    def _mark_dirty(self):
+        self._dirty = True
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_delay)
+        await self.flush()
+
+    async def flush(self):
+        """未保存の変更をまとめて書き出す（tmp → os.replace で原子的に置き換え）。"""
+        async with self._flush_lock:
+            async with self._lock:
+                if not self._dirty or self._cache is None:
+                    return
+                snapshot = dict(self._cache)
+                self._dirty = False
+            start = time.perf_counter()
+            try:
+                size = await asyncio.to_thread(_kv_save, snapshot, self.path)
+                metrics.observe("kv_save_seconds", time.perf_counter() - start)
+                metrics.inc("kv_bytes_written_total", size)
+                metrics.set_gauge("kv_file_bytes", size)
+            except Exception as e:
+                self._dirty = True
+                log.exception("kv flush failed: %s", e)
+
+    async def close(self):
+        await self.flush()
+        # 本体に最新の連番を書けたので、先取り分を返して次回起動で番号が飛ばないようにする
+        async with self._counter_lock:
+            async with self._lock:
+                if self._dirty or self._cache is None or not self._reserved:
+                    return
+                current = {k: int(self._cache[k]) for k in self._reserved if (self._cache.get(k) or "").isdigit()}
+            await asyncio.to_thread(_kv_save_counters, current, self.path)
+            self._reserved, self._persisted = dict(current), dict(current)
+
+    async def get(self, key: str) -> str | None:
+        async with self._lock:
+            return self._data().get(key)
+
+    async def set(self, key: str, value: str):
+        async with self._lock:
+            self._put(self._data(), key, value)
+            self._mark_dirty()
+
+    async def delete(self, key: str):
+        async with self._lock:
+            if self._pop(self._data(), key):
+                self._mark_dirty()
+
+    async def all(self) -> dict:
+        async with self._lock:
+            return dict(self._data())
+
+    async def pop(self, key: str) -> str | None:
+        async with self._lock:
+            data = self._data()
+            value = data.get(key)
+            if self._pop(data, key):
+                self._mark_dirty()
+            return value
+
+    async def incr(self, key: str, delta: int = 1) -> int:
+        async with self._lock:
+            data = self._data()
+            cur = data.get(key)
+            n = (int(cur) if cur and cur.isdigit() else 0) + delta
+            self._put(data, key, str(n))
+            self._mark_dirty()
+            if n > self._reserved.get(key, 0):
+                self._reserved[key] = n + max(KV_COUNTER_BLOCK, 1) - 1
+        # 連番は表示に使うので、先取り上限が書き終わるまでは返さない（本体の書き出しは待たない）
+        if n > self._persisted.get(key, 0):
+            await self._persist_counters(key, n)
+        return n
+
+    async def _persist_counters(self, key: str, n: int):
+        async with self._counter_lock:
+            if n <= self._persisted.get(key, 0):
+                return  # 先に書いた呼び出しが同じブロックを保存済み
+            async with self._lock:
+                snapshot = dict(self._reserved)
+            await asyncio.to_thread(_kv_save_counters, snapshot, self.path)
+            self._persisted = snapshot
+
+    async def scan(self, prefix: str, page: int = 500, after: str | None = None):
+        # ページ単位でロックを取り、yield 中はロックを手放す
+        cursor, inclusive = (after, False) if after else (prefix, True)
+        while True:
+            async with self._lock:
+                data = self._data()
+                keys = self._keys
+                i = bisect.bisect_left(keys, cursor) if inclusive else bisect.bisect_right(keys, cursor)
+                batch = []
+                for k in keys[i:i + page]:
+                    if not k.startswith(prefix):
+                        break
+                    batch.append((k, data[k]))
+            for item in batch:
+                yield item
+            if len(batch) < page:
+                return
+            cursor, inclusive = batch[-1][0], False
+
+    async def get_many(self, keys) -> dict:
+        async with self._lock:
+            data = self._data()
+            return {k: data[k] for k in keys if k in data}
+
+    async def set_many(self, items: dict):
+        if not items:
+            return
+        async with self._lock:
+            data = self._data()
+            for k, v in items.items():
+                self._put(data, k, v)
+            self._mark_dirty()
+
+    async def delete_many(self, keys):
+        async with self._lock:
+            data = self._data()
+            changed = False
+            for k in keys:
+                changed = self._pop(data, k) or changed
+            if changed:
+                self._mark_dirty()
+
+class SqliteKVBackend(KVBackend):
+    """SQLite（WAL）。主キー索引で引くので件数が増えても O(log n)。
+    ブロッキングI/Oは専用スレッド1本で実行し、イベントループを止めない。"""
+    # SQL文は固定文字列にして sqlite3 のステートメントキャッシュ（prepared）を効かせる
+    SQL_GET = "SELECT v FROM kv WHERE k = ?"
+    SQL_SET = "INSERT INTO kv (k, v) VALUES (?, ?) ON CONFLICT(k) DO UPDATE SET v = excluded.v"
+    SQL_DEL = "DELETE FROM kv WHERE k = ?"
+    SQL_POP = "DELETE FROM kv WHERE k = ? RETURNING v"
+    SQL_ALL = "SELECT k, v FROM kv"
+    SQL_INCR = (
+        "INSERT INTO kv (k, v) VALUES (?, ?) "
+        "ON CONFLICT(k) DO UPDATE SET v = CAST(CAST(kv.v AS INTEGER) + ? AS TEXT) RETURNING v"
+    )
+    SQL_SCAN_FIRST = "SELECT k, v FROM kv WHERE k >= ? AND k < ? ORDER BY k LIMIT ?"
+    SQL_SCAN_NEXT = "SELECT k, v FROM kv WHERE k > ? AND k < ? ORDER BY k LIMIT ?"
+    MANY_CHUNK = 500
+
+    def __init__(self, path: str, import_json_path: str | None = None):
+        self.path = path
+        self.import_json_path = import_json_path
+        self._conn: sqlite3.Connection | None = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="kv-sqlite")
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, timeout=KV_SQLITE_BUSY_TIMEOUT)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS kv (k TEXT PRIMARY KEY, v TEXT NOT NULL) WITHOUT ROWID")
+            conn.execute("CREATE TABLE IF NOT EXISTS kv_meta (k TEXT PRIMARY KEY, v TEXT NOT NULL)")
+            if self.import_json_path:
+                _kv_import_json(conn, self.import_json_path)
+            self._conn = conn
+        return self._conn
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    def _get(self, key: str) -> str | None:
+        row = self._db().execute(self.SQL_GET, (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set(self, key: str, value: str):
+        self._db().execute(self.SQL_SET, (key, value))
+
+    def _delete(self, key: str):
+        self._db().execute(self.SQL_DEL, (key,))
+
+    def _all(self) -> dict:
+        return dict(self._db().execute(self.SQL_ALL).fetchall())
+
+    def _pop(self, key: str) -> str | None:
+        row = self._db().execute(self.SQL_POP, (key,)).fetchone()
+        return row[0] if row else None
+
+    def _incr(self, key: str, delta: int) -> int:
+        return int(self._db().execute(self.SQL_INCR, (key, str(delta), delta)).fetchone()[0])
+
+    def _scan_page(self, cursor: str, upper: str, first: bool, page: int) -> list:
+        sql = self.SQL_SCAN_FIRST if first else self.SQL_SCAN_NEXT
+        return self._db().execute(sql, (cursor, upper, page)).fetchall()
+
+    def _get_many(self, keys: list) -> dict:
+        out = {}
+        for i in range(0, len(keys), self.MANY_CHUNK):
+            chunk = keys[i:i + self.MANY_CHUNK]
+            sql = f"SELECT k, v FROM kv WHERE k IN ({','.join('?' * len(chunk))})"
+            out.update(self._db().execute(sql, chunk).fetchall())
+        return out
+
+    def _executemany(self, sql: str, rows: list):
+        conn = self._db()
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(sql, rows)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def get(self, key: str) -> str | None:
+        return await self._run(self._get, key)
+
+    async def set(self, key: str, value: str):
+        await self._run(self._set, key, value)
+        metrics.inc("kv_bytes_written_total", len(key) + len(value))
+
+    async def delete(self, key: str):
+        await self._run(self._delete, key)
+
+    async def all(self) -> dict:
+        return await self._run(self._all)
+
+    async def incr(self, key: str, delta: int = 1) -> int:
+        return await self._run(self._incr, key, delta)
+
+    async def pop(self, key: str) -> str | None:
+        return await self._run(self._pop, key)
+
+    async def scan(self, prefix: str, page: int = 500, after: str | None = None):
+        upper = _prefix_upper(prefix)
+        cursor, first = (after, False) if after else (prefix, True)
+        while True:
+            rows = await self._run(self._scan_page, cursor, upper, first, page)
+            for row in rows:
+                yield row[0], row[1]
+            if len(rows) < page:
+                return
+            cursor, first = rows[-1][0], False
+
+    async def get_many(self, keys) -> dict:
+        keys = list(keys)
+        return await self._run(self._get_many, keys) if keys else {}
+
+    async def set_many(self, items: dict):
+        if items:
+            rows = list(items.items())
+            await self._run(self._executemany, self.SQL_SET, rows)
+            metrics.inc("kv_bytes_written_total", sum(len(k) + len(v) for k, v in rows))
+
+    async def delete_many(self, keys):
+        rows = [(k,) for k in keys]
+        if rows:
+            await self._run(self._executemany, self.SQL_DEL, rows)
+            metrics.inc("kv_bytes_written_total", sum(len(k) for k, in rows))
+
+    async def close(self):
+        await self._run(self._close)
+
+def _prefix_upper(prefix: str) -> str:
+    """prefix で始まる全キーより大きい最小の文字列（範囲検索の上限）。"""
+    if not prefix:
+        return chr(0x10FFFF)
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def _kv_import_json(conn: sqlite3.Connection, json_path: str):
+    """bot_kv.json を一度だけ取り込む（取り込み済みなら何もしない）。既存キーは上書きしない。"""
+    if conn.execute("SELECT 1 FROM kv_meta WHERE k = 'imported_json'").fetchone():
+        return
+    data = _kv_load(json_path)
+    _kv_merge_counters(data, json_path)
+    conn.execute("BEGIN IMMEDIATE")  # 複数プロセスが同時に起動しても取り込みは1回
+    try:
+        if conn.execute("SELECT 1 FROM kv_meta WHERE k = 'imported_json'").fetchone():
+            conn.execute("ROLLBACK")
+            return
+        conn.executemany("INSERT OR IGNORE INTO kv (k, v) VALUES (?, ?)", [(k, v) for k, v in data.items()])
+        conn.execute("INSERT INTO kv_meta (k, v) VALUES ('imported_json', ?)", (json_path,))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    if data:
+        log.info(f"[kv] imported {len(data)} keys from {json_path}")
+
+def _make_kv_backend() -> KVBackend:
+    if KV_BACKEND == "sqlite":
+        return SqliteKVBackend(KV_SQLITE_PATH, import_json_path=DB_PATH)
+    return JsonKVBackend(DB_PATH, KV_FLUSH_DELAY)
+
+_kv_backend = _make_kv_backend()
+
+async def kv_set(key: str, value: str):
+    start = time.perf_counter()
+    await _kv_backend.set(key, value)
+    metrics.observe("kv_op_seconds", time.perf_counter() - start, op="set")
+
+async def kv_get(key: str) -> str | None:
+    start = time.perf_counter()
+    try:
+        return await _kv_backend.get(key)
+    finally:
+        metrics.observe("kv_op_seconds", time.perf_counter() - start, op="get")
+
+async def kv_del(key: str):
+    start = time.perf_counter()
+    await _kv_backend.delete(key)
+    metrics.observe("kv_op_seconds", time.perf_counter() - start, op="del")
+
+async def kv_pop(key: str) -> str | None:
+    start = time.perf_counter()
+    try:
+        return await _kv_backend.pop(key)
+    finally:
+        metrics.observe("kv_op_seconds", time.perf_counter() - start, op="pop")
+
+async def kv_all() -> dict:
+    return await _kv_backend.all()
+
+async def kv_incr(key: str, delta: int = 1) -> int:
+    start = time.perf_counter()
+    try:
+        return await _kv_backend.incr(key, delta)
+    finally:
+        metrics.observe("kv_op_seconds", time.perf_counter() - start, op="incr")
+
+def kv_scan(prefix: str, page: int = 500, after: str | None = None):
+    """async for key, value in kv_scan("cleaner:purge:") のように使う。"""
+    return _kv_backend.scan(prefix, page, after)
+
+async def kv_get_many(keys) -> dict:
+    return await _kv_backend.get_many(keys)
+
+async def kv_set_many(items: dict):
+    await _kv_backend.set_many(items)
+
+async def kv_del_many(keys):
+    await _kv_backend.delete_many(keys)
+
+async def kv_flush():
+    await _kv_backend.flush()
+
+async def kv_close():
+    await _kv_backend.close()
+
+# ========= 権限/設定 =========
+ALLOWED_USER_IDS = {716667546241335328, 440893662701027328}
+
+def is_allowed_user(user: discord.abc.User) -> bool:
+    return user.id in ALLOWED_USER_IDS
+
+async def guard_allowed(interaction: discord.Interaction) -> bool:
+    if not is_allowed_user(interaction.user):
+        await interaction.response.send_message("この操作を行えるのは許可ユーザーだけです。", ephemeral=True)
+        return False
+    return True
+
+# ========= 掲示板用 KVキー =========
+PANEL_KEY    = "anonboard:panel:{channel_id}"
+COUNTER_KEY  = "anonboard:counter:{channel_id}"
+LOGCHAN_KEY  = "anonboard:logchan:{channel_id}"
+POSTMAP_KEY  = "anonboard:post:{message_id}"      # 公開メッセージID -> 投稿者情報(JSON)
+PENDING_KEY  = "anonboard:pending:{log_msg_id}"   # 承認待ちログメッセージID -> 申請情報(JSON)
+PENDING_CLAIM_KEY = "anonboard:claim:pending:{log_msg_id}"  # 承認/却下の処理中の印（kv_incr で1回だけ取れる）
+AUTODEL_KEY  = "anonboard:autodel_sec:{channel_id}"  # 送信後◯秒削除（新規のみ）
+RETENTION_KEY = "anonboard:retention_days:{channel_id}"  # 投稿記録の保持日数（0/未設定は既定値）
+CHGUILD_KEY  = "anonboard:chguild:{channel_id}"   # チャンネル -> ギルドID（投稿記録から省くため1回だけ保存）
+LOGDIGEST_KEY = "anonboard:logdigest:{channel_id}"  # ログ先チャンネル -> まとめ送信の間隔（秒）
+WEBHOOK_KEY  = "anonboard:webhook:{channel_id}"   # 掲示板 -> 投稿用 Webhook ID（ある間は Webhook で公開）
+AUTHOR_INDEX_KEY = "anonboard:byauthor:{channel_id}:{author_id}:{rev_id:020d}"  # 値: 公開メッセージID（新しい順に並ぶ）
+AUTHOR_INDEX_PREFIX = "anonboard:byauthor:"
+AUTHOR_INDEX_DONE_KEY = "anonboard:meta:author_index"  # 既存投稿からの索引作成が済んだ印
+POSTMAP_PREFIX = "anonboard:post:"
+PENDING_PREFIX = "anonboard:pending:"
+PENDING_CLAIM_PREFIX = "anonboard:claim:pending:"
+
+def gkey_panel(chid: int) -> str:       return PANEL_KEY.format(channel_id=chid)
+def gkey_counter(chid: int) -> str:     return COUNTER_KEY.format(channel_id=chid)
+def gkey_logchan(chid: int) -> str:     return LOGCHAN_KEY.format(channel_id=chid)
+def gkey_postmap(mid: int) -> str:      return POSTMAP_KEY.format(message_id=mid)
+def gkey_pending(log_mid: int) -> str:  return PENDING_KEY.format(log_msg_id=log_mid)
+def gkey_pending_claim(log_mid: int) -> str: return PENDING_CLAIM_KEY.format(log_msg_id=log_mid)
+def gkey_autodel(chid: int) -> str:     return AUTODEL_KEY.format(channel_id=chid)
+
+_SNOWFLAKE_MAX = (1 << 64) - 1
+def gkey_author_index(chid: int, author_id: int, mid: int) -> str:
+    # ID を反転して入れるので、キー順＝新しい投稿順になる
+    return AUTHOR_INDEX_KEY.format(channel_id=chid, author_id=author_id, rev_id=_SNOWFLAKE_MAX - mid)
+def author_index_prefix(chid: int, author_id: int) -> str:
+    return f"{AUTHOR_INDEX_PREFIX}{chid}:{author_id}:"
+
+
+# ========= チャンネル設定キャッシュ =========
+# 自動削除秒数・パネルID・ログ先をメモリに保持し、on_message ではKVを読まない。
+# 設定の書き込みは必ず set_channel_config() を通す（KVとキャッシュを同時に更新）。
+# 複数プロセスで共有ストアを使うときは、他プロセスの書き込みを CHANCFG_REFRESH_SEC ごとに読み直して取り込む。
+CHANCFG_REFRESH_SEC = float(os.getenv("CHANCFG_REFRESH_SEC", "60"))
+class ChannelConfig:
+    __slots__ = ("autodel_sec", "panel_id", "log_channel_id", "retention_days", "guild_id", "log_digest_sec", "webhook_id")
+
+    def __init__(self):
+        self.autodel_sec: int | None = None
+        self.panel_id: int | None = None
+        self.log_channel_id: int | None = None
+        self.retention_days: int | None = None
+        self.guild_id: int | None = None
+        self.log_digest_sec: int | None = None  # ログ先としての設定
+        self.webhook_id: int | None = None
+
+    def is_empty(self) -> bool:
+        return all(getattr(self, f) is None for f in self.__slots__)
+
+_CHANCFG_KEYS = {
+    "autodel_sec": AUTODEL_KEY,
+    "panel_id": PANEL_KEY,
+    "log_channel_id": LOGCHAN_KEY,
+    "retention_days": RETENTION_KEY,
+    "guild_id": CHGUILD_KEY,
+    "log_digest_sec": LOGDIGEST_KEY,
+    "webhook_id": WEBHOOK_KEY,
+}
+_chan_cfg: dict[int, ChannelConfig] = {}  # 設定のあるチャンネルだけを持つ
+_chan_cfg_loaded = False
+_chan_cfg_version = 0  # このプロセスでの書き込み回数（読み直し中に書き込みがあれば結果を捨てる）
+_chan_cfg_lock = asyncio.Lock()
+
+def _chancfg_apply(chid: int, field: str, value: int | None, cache: dict[int, ChannelConfig] | None = None):
+    if cache is None:
+        cache = _chan_cfg
+    cfg = cache.get(chid)
+    if cfg is None:
+        if value is None:
+            return
+        cfg = cache[chid] = ChannelConfig()
+    setattr(cfg, field, value)
+    if cfg.is_empty():
+        del cache[chid]
+
+async def _scan_channel_configs(cache: dict[int, ChannelConfig]):
+    for field, template in _CHANCFG_KEYS.items():
+        prefix = template.split("{")[0]
+        async for k, v in kv_scan(prefix):
+            try:
+                chid = int(k[len(prefix):])
+            except ValueError:
+                continue
+            if v and v.isdigit():
+                _chancfg_apply(chid, field, int(v), cache)
+
+async def load_channel_configs():
+    """起動時に1回だけ、設定キーを前方一致スキャンしてキャッシュを作る。"""
+    global _chan_cfg_loaded
+    async with _chan_cfg_lock:
+        if _chan_cfg_loaded:
+            return
+        await _scan_channel_configs(_chan_cfg)
+        _chan_cfg_loaded = True
+
+async def refresh_channel_configs() -> bool:
+    """共有ストアから設定を読み直してキャッシュを置き換える。読み直し中にこのプロセスで書き込みがあれば見送る。"""
+    async with _chan_cfg_lock:
+        version = _chan_cfg_version
+        fresh: dict[int, ChannelConfig] = {}
+        await _scan_channel_configs(fresh)
+        if version != _chan_cfg_version:
+            return False  # 次の回で読み直す
+        _chan_cfg.clear()
+        _chan_cfg.update(fresh)
+        return True
+
+async def _chancfg_refresh_loop():
+    while True:
+        await asyncio.sleep(CHANCFG_REFRESH_SEC)
+        try:
+            await refresh_channel_configs()
+        except Exception as e:
+            log.exception(f"[config] refresh failed: {e}")
+
+def channel_config(chid: int) -> ChannelConfig | None:
+    return _chan_cfg.get(chid)
+
+async def set_channel_config(chid: int, field: str, value: int | None):
+    """設定を保存してキャッシュも更新する。None は削除。"""
+    global _chan_cfg_version
+    _chan_cfg_version += 1
+    key = _CHANCFG_KEYS[field].format(channel_id=chid)
+    if value is None:
+        await kv_del(key)
+    else:
+        await kv_set(key, str(int(value)))
+    _chancfg_apply(chid, field, value)
+    _chan_cfg_version += 1  # 書き込みの前後どちらかに重なった読み直しは捨てさせる
+
+async def remember_channel_guild(chid: int, guild_id: int | None):
+    """投稿記録に guild_id を持たせない代わりに、チャンネルごとに1回だけ保存する。"""
+    cfg = _chan_cfg.get(chid)
+    if guild_id and (cfg is None or cfg.guild_id != guild_id):
+        await set_channel_config(chid, "guild_id", guild_id)
+
+# ========= 投稿記録のエンコード =========
+# 値はフィールド名を持たない JSON 配列（先頭要素が形式番号）。キーに入っているIDと guild_id は持たない。
+# 旧形式（フィールド名付きの JSON オブジェクト）もそのまま読める。
+RECORD_VERSION = 1
+
+def _pack(*fields) -> str:
+    return json.dumps([RECORD_VERSION, *fields], ensure_ascii=False, separators=(",", ":"))
+
+def _legacy_guild_id(value: str) -> int | None:
+    """旧形式の記録が持っていた guild_id。新形式では持たないので、移行時にチャンネル設定へ移す。"""
+    if not value.startswith("{"):
+        return None
+    try:
+        return int(json.loads(value).get("guild_id") or 0) or None
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+@dataclass(slots=True)
+class PostRecord:
+    """公開メッセージ1件の投稿者情報（reveal用）。キー: anonboard:post:{message_id}"""
+    message_id: int
+    channel_id: int
+    author_id: int
+    author_name: str
+    author_display: str
+    anon_display: str | None = None  # 匿名投稿なら連番
+    img_url: str | None = None
+
+    @property
+    def anonymous(self) -> bool:
+        return self.anon_display is not None
+
+    @property
+    def guild_id(self) -> int | None:
+        cfg = channel_config(self.channel_id)
+        return cfg.guild_id if cfg else None
+
+    def encode(self) -> str:
+        return _pack(self.channel_id, self.author_id, self.author_name, self.author_display, self.anon_display, self.img_url)
+
+    @classmethod
+    def decode(cls, message_id: int, value: str) -> "PostRecord":
+        if value.startswith("["):
+            _, channel_id, author_id, author_name, author_display, anon_display, img_url = json.loads(value)
+            return cls(message_id, channel_id, author_id, author_name, author_display, anon_display, img_url)
+        d = json.loads(value)
+        return cls(
+            message_id=message_id,
+            channel_id=int(d["channel_id"]),
+            author_id=int(d["author_id"]),
+            author_name=d.get("author_name") or "",
+            author_display=d.get("author_display") or "",
+            anon_display=d.get("anon_display") if d.get("anonymous") else None,
+            img_url=d.get("img_url"),
+        )
+
+@dataclass(slots=True)
+class PendingRecord:
+    """画像承認待ち1件。投稿者名などは PostRecord 側にある。キー: anonboard:pending:{log_message_id}
+    承認/却下時にメッセージを取得せず、保存したIDと内容から本文・承認カードを作り直す。"""
+    log_message_id: int
+    board_channel_id: int
+    board_message_id: int
+    display_name: str
+    content: str
+    img_url: str
+    log_channel_id: int | None = None
+    author_id: int = 0
+    anonymous: bool = False
+    img_meta: str = ""  # 事前確認した画像の縦横・サイズ（承認カード表示用）
+    webhook_id: int | None = None  # 本文を Webhook で公開した場合（編集も同じ Webhook から）
+
+    def encode(self) -> str:
+        return _pack(self.board_channel_id, self.board_message_id, self.display_name, self.content, self.img_url,
+                     self.log_channel_id, self.author_id, int(self.anonymous), self.img_meta, self.webhook_id)
+
+    @classmethod
+    def decode(cls, log_message_id: int, value: str) -> "PendingRecord":
+        if value.startswith("["):
+            fields = json.loads(value)[1:]
+            rec = cls(log_message_id, *fields[:5])
+            if len(fields) > 5:
+                rec.log_channel_id, rec.author_id, rec.anonymous = fields[5], fields[6], bool(fields[7])
+            if len(fields) > 8:
+                rec.img_meta = fields[8]
+            if len(fields) > 9:
+                rec.webhook_id = fields[9]
+            return rec
+        d = json.loads(value)
+        return cls(
+            log_message_id=log_message_id,
+            board_channel_id=int(d["board_channel_id"]),
+            board_message_id=int(d["board_message_id"]),
+            display_name=(d.get("anon_display") if d.get("anonymous") else d.get("author_display")) or "",
+            content=d.get("content") or "",
+            img_url=d.get("img_url") or "",
+            author_id=int(d.get("author_id") or 0),
+            anonymous=bool(d.get("anonymous")),
+        )
+
+# ========= Discord REST 送信キュー =========
+# すべてのREST呼び出しを優先度付きキューに通し、後片付けの削除が投稿や承認を待たせないようにする。
+PRIO_INTERACTIVE = 0  # 投稿・承認など利用者が待っている操作
+PRIO_LOG = 1          # ログチャンネルへの送信
+PRIO_PANEL = 2        # パネル再掲
+PRIO_CLEANUP = 3      # 自動削除・定期掃除
+PRIO_NAMES = {PRIO_INTERACTIVE: "interactive", PRIO_LOG: "log", PRIO_PANEL: "panel", PRIO_CLEANUP: "cleanup"}
+REST_MAX_CONCURRENCY = int(os.getenv("REST_MAX_CONCURRENCY", "8"))      # 全体の同時実行数
+REST_ROUTE_CONCURRENCY = int(os.getenv("REST_ROUTE_CONCURRENCY", "2"))  # ルート（操作+チャンネル）ごとの同時実行数
+
+class OutboundQueue:
+    """優先度順にREST呼び出しを実行する。submit() は結果（または例外）を返す。
+    ルートの同時実行数が埋まっている呼び出しはそのルート専用の待ち列に回し、全体の枠は他のルートに使わせる。"""
+    def __init__(self, max_concurrency: int, route_concurrency: int):
+        self.max_concurrency = max(1, max_concurrency)
+        self.route_concurrency = max(1, route_concurrency)
+        self._heap: list[tuple] = []              # すぐ実行できる候補 (priority, seq, enqueued, route, factory, fut)
+        self._parked: dict[str, list[tuple]] = {}  # route -> ルートの枠待ち（同じ形のヒープ）
+        self._running: dict[str, int] = {}
+        self._active = 0
+        self._seq = itertools.count()
+        self._tasks: set[asyncio.Task] = set()
+        self.depth = {p: 0 for p in PRIO_NAMES}
+        self.submitted = {p: 0 for p in PRIO_NAMES}
+        self.failed = {p: 0 for p in PRIO_NAMES}
+
+    async def submit(self, priority: int, route: str, factory):
+        """factory は呼ぶとコルーチンを返す関数（例: lambda: ch.send(...)）。"""
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (priority, next(self._seq), time.perf_counter(), route, factory, fut))
+        self.depth[priority] += 1
+        self.submitted[priority] += 1
+        self._pump()
+        return await fut
+
+    def _pump(self):
+        while self._active < self.max_concurrency and self._heap:
+            item = heapq.heappop(self._heap)
+            priority, route, fut = item[0], item[3], item[5]
+            if fut.done():
+                self.depth[priority] -= 1
+                continue
+            if self._running.get(route, 0) >= self.route_concurrency:
+                heapq.heappush(self._parked.setdefault(route, []), item)
+                continue
+            self.depth[priority] -= 1
+            self._active += 1
+            self._running[route] = self._running.get(route, 0) + 1
+            t = asyncio.create_task(self._run(item))
+            self._tasks.add(t)
+            t.add_done_callback(self._tasks.discard)
+
+    def _release(self, route: str):
+        self._active -= 1
+        n = self._running[route] - 1
+        if n:
+            self._running[route] = n
+        else:
+            del self._running[route]
+        parked = self._parked.get(route)
+        if parked:
+            heapq.heappush(self._heap, heapq.heappop(parked))
+            if not parked:
+                del self._parked[route]
+        self._pump()
+
+    async def _run(self, item: tuple):
+        priority, _, enqueued, route, factory, fut = item
+        start = time.perf_counter()
+        prio = PRIO_NAMES[priority]
+        metrics.observe("rest_queue_wait_seconds", start - enqueued, priority=prio)
+        try:
+            result = await factory()
+        except asyncio.CancelledError:
+            if not fut.done():
+                fut.cancel()
+            raise
+        except Exception as e:
+            self.failed[priority] += 1
+            if not fut.done():
+                fut.set_exception(e)
+        else:
+            if not fut.done():
+                fut.set_result(result)
+        finally:
+            metrics.observe("rest_seconds", time.perf_counter() - start, priority=prio, op=route.split(":", 1)[0])
+            self._release(route)
+
+    def snapshot(self) -> dict:
+        return {
+            name: {"depth": self.depth[p], "submitted": self.submitted[p], "failed": self.failed[p]}
+            for p, name in PRIO_NAMES.items()
+        }
+
+outbound = OutboundQueue(REST_MAX_CONCURRENCY, REST_ROUTE_CONCURRENCY)
+
+async def rest(priority: int, route: str, factory):
+    return await outbound.submit(priority, route, factory)
+
+# ========= 送信後◯秒削除のスケジューラ =========
+AUTODEL_QUEUE_KEY = "anonboard:autodelq:{channel_id}:{message_id}"  # 値: "削除予定時刻（UNIX秒） ギルドID"
+AUTODEL_QUEUE_PREFIX = "anonboard:autodelq:"
+def gkey_autodelq(chid: int, mid: int) -> str: return AUTODEL_QUEUE_KEY.format(channel_id=chid, message_id=mid)
+
+# 一括削除は作成から14日以内のメッセージのみ（境界付近は余裕を持って個別削除へ）
+BULK_DELETE_MAX_AGE = datetime.timedelta(days=14) - datetime.timedelta(minutes=5)
+BULK_DELETE_CHUNK = 100
+# 削除が 429・5xx・通信エラーで失敗したら、この秒数から倍々に（上限 AUTODEL_RETRY_MAX）間を空けてやり直す
+AUTODEL_RETRY_BASE = 30.0
+AUTODEL_RETRY_MAX = 3600.0
+
+def _is_permanent_delete_error(e: BaseException) -> bool:
+    """NotFound・Forbidden など、やり直しても結果が変わらない失敗か（429・5xx・通信エラーは一時的）。"""
+    return isinstance(e, discord.HTTPException) and e.status < 500 and e.status != 429
+
+class AutoDeleteScheduler:
+    """自動削除を1本のタスクでまとめて処理する。
+    ヒープには (削除予定時刻, channel_id, message_id, guild_id) だけを持ち、KVにも保存して再起動後に再開する。
+    シャード分割時は自分の受け持つギルドの分だけを読み込む。"""
+    def __init__(self, client: commands.Bot):
+        self.client = client
+        self._heap: list[tuple[float, int, int, int]] = []
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._attempts: dict[int, int] = {}  # 一時的な失敗でやり直し中のメッセージ -> 失敗回数
+
+    async def restore(self):
+        async for k, v in kv_scan(AUTODEL_QUEUE_PREFIX):
+            try:
+                ch_id, msg_id = (int(x) for x in k[len(AUTODEL_QUEUE_PREFIX):].split(":"))
+                due_s, _, guild_s = v.partition(" ")
+                due, guild_id = float(due_s), int(guild_s or 0)  # 旧形式はギルド不明（0）
+            except Exception:
+                continue
+            if guild_id and not owns_guild(self.client, guild_id):
+                continue
+            self._heap.append((due, ch_id, msg_id, guild_id))
+        heapq.heapify(self._heap)
+        if self._heap:
+            log.info(f"[autodel] restored {len(self._heap)} pending deletions")
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    @property
+    def started(self) -> bool:
+        return self._task is not None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def schedule(self, channel_id: int, message_id: int, delay: float, guild_id: int | None = None):
+        due = time.time() + delay
+        await kv_set(gkey_autodelq(channel_id, message_id), f"{due:.3f} {guild_id or 0}")
+        heapq.heappush(self._heap, (due, channel_id, message_id, guild_id or 0))
+        if self._heap[0][2] == message_id:
+            self._wakeup.set()
+
+    async def _run(self):
+        await self.client.wait_until_ready()
+        while True:
+            try:
+                self._wakeup.clear()
+                if not self._heap:
+                    await self._wakeup.wait()
+                    continue
+                delay = self._heap[0][0] - time.time()
+                if delay > 0:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                now = time.time()
+                due: dict[int, list[int]] = {}
+                guilds: dict[int, int] = {}
+                while self._heap and self._heap[0][0] <= now:
+                    _, ch_id, msg_id, guild_id = heapq.heappop(self._heap)
+                    due.setdefault(ch_id, []).append(msg_id)
+                    guilds[ch_id] = guilds.get(ch_id) or guild_id
+                for ch_id, msg_ids in due.items():
+                    await self._delete_in_channel(ch_id, msg_ids, guilds[ch_id])
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                log.exception(f"[autodel] scheduler error: {e}")
+
+    async def _delete_in_channel(self, channel_id: int, message_ids: list[int], guild_id: int = 0):
+        ch = self.client.get_channel(channel_id)
+        if ch is None and not guild_id and is_sharded(self.client):
+            return  # 旧形式で他シャードのチャンネルかもしれない → 記録は受け持ちのプロセスに任せる
+        retry: list[int] = []
+        if isinstance(ch, discord.TextChannel):
+            bulk_after = discord.utils.utcnow() - BULK_DELETE_MAX_AGE
+            bulk = [m for m in message_ids if discord.utils.snowflake_time(m) > bulk_after]
+            single = [m for m in message_ids if discord.utils.snowflake_time(m) <= bulk_after]
+            for i in range(0, len(bulk), BULK_DELETE_CHUNK):
+                chunk = bulk[i:i + BULK_DELETE_CHUNK]
+                try:
+                    await rest(PRIO_CLEANUP, f"bulk_delete:{channel_id}",
+                               lambda chunk=chunk: ch.delete_messages([discord.Object(id=m) for m in chunk]))
+                except Exception:
+                    # 既に消えたメッセージが混じっている等 → 個別に
+                    single.extend(chunk)
+            for m in single:
+                try:
+                    await rest(PRIO_CLEANUP, f"delete:{channel_id}", ch.get_partial_message(m).delete)
+                except Exception as e:
+                    if not _is_permanent_delete_error(e):
+                        retry.append(m)  # 消せたとは限らないので記録は残してやり直す
+        retrying = set(retry)
+        done = [m for m in message_ids if m not in retrying]
+        for m in done:
+            self._attempts.pop(m, None)
+        await kv_del_many([gkey_autodelq(channel_id, m) for m in done])
+        for m in retry:
+            n = self._attempts[m] = self._attempts.get(m, 0) + 1
+            await self.schedule(channel_id, m, min(AUTODEL_RETRY_BASE * 2 ** (n - 1), AUTODEL_RETRY_MAX), guild_id)
+        if retry:
+            log.warning(f"[autodel] channel={channel_id}: {len(retry)} deletions failed, retrying later")
+
+# ========= 定期掃除（掲示板と無関係） =========
+PURGE_KEY = "cleaner:purge:{channel_id}"  # JSON: {"interval": int, "keep_hours": int, "batch_limit": int}
+PURGE_PREFIX = "cleaner:purge:"
+def gkey_purge(chid: int) -> str: return PURGE_KEY.format(channel_id=chid)
+
+PURGE_CURSOR_KEY = "cleaner:cursor:{channel_id}"  # これ以前（ID以下）は処理済み
+def gkey_purge_cursor(chid: int) -> str: return PURGE_CURSOR_KEY.format(channel_id=chid)
+PURGE_SCAN_LIMIT = 1000
+# 14日超のメッセージは個別削除しかできないので、トークンバケットでペースを抑える
+PURGE_SINGLE_DELETE_RATE = float(os.getenv("PURGE_SINGLE_DELETE_RATE", "1.0"))  # 件/秒
+
+class TokenBucket:
+    """単純なトークンバケット。acquire() はトークンが貯まるまで待つ。"""
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+_single_delete_bucket = TokenBucket(PURGE_SINGLE_DELETE_RATE, 5)
+
+async def _paced_delete(channel: discord.TextChannel, msg: discord.Message) -> bool | None:
+    """True: 削除した（既に無い場合も） / None: 権限不足などで消せない（やり直さない） / False: 一時的な失敗。"""
+    await _single_delete_bucket.acquire()
+    try:
+        await rest(PRIO_CLEANUP, f"delete:{channel.id}", msg.delete)
+    except discord.NotFound:
+        pass
+    except Exception as e:
+        if _is_permanent_delete_error(e):
+            log.warning(f"[purge] skip message={msg.id} channel={channel.id}: {e!r}")
+            return None
+        return False
+    return True
+
+async def _purge_once(channel: discord.TextChannel, keep_hours: int, batch_limit: int) -> int:
+    """1回分の掃除。保存済みカーソルより新しく cutoff より古い範囲だけを古い順に見る。削除件数を返す。"""
+    now = discord.utils.utcnow()
+    cutoff = now - datetime.timedelta(hours=keep_hours)
+    bulk_after = now - BULK_DELETE_MAX_AGE
+    cursor_s = await kv_get(gkey_purge_cursor(channel.id))
+    after = discord.Object(id=int(cursor_s)) if cursor_s and cursor_s.isdigit() else None
+
+    to_delete_bulk, to_delete_single = [], []
+    last_seen = None
+    async for msg in channel.history(limit=PURGE_SCAN_LIMIT, after=after, before=cutoff, oldest_first=True):
+        if len(to_delete_bulk) + len(to_delete_single) >= batch_limit:
+            break
+        last_seen = msg.id
+        if msg.pinned:
+            continue
+        # 14日以内: bulk / 超過: 個別
+        if msg.created_at > bulk_after:
+            to_delete_bulk.append(msg)
+        else:
+            to_delete_single.append(msg)
+
+    ok = True
+    deleted = 0
+    for i in range(0, len(to_delete_bulk), BULK_DELETE_CHUNK):
+        chunk = to_delete_bulk[i:i + BULK_DELETE_CHUNK]
+        try:
+            await rest(PRIO_CLEANUP, f"bulk_delete:{channel.id}", lambda chunk=chunk: channel.delete_messages(chunk))
+            deleted += len(chunk)
+        except Exception:
+            # 権限/件数などで失敗したら個別に
+            to_delete_single.extend(chunk)
+
+    for m in to_delete_single:
+        result = await _paced_delete(channel, m)
+        if result:
+            deleted += 1
+        elif result is False:
+            ok = False
+
+    # 一時的な失敗が無かったときだけカーソルを進める（消せないと確定したものは飛ばす）
+    if ok and last_seen is not None:
+        await kv_set(gkey_purge_cursor(channel.id), str(last_seen))
+
+    if deleted:
+        log.info(f"[purge] channel={channel.id} deleted={deleted} (<{keep_hours}h)")
+    return deleted
+
+# 全チャンネルの定期掃除を1つのスーパーバイザで回す（同時実行数を制限し、開始時刻をジッターで散らす）
+PURGE_MAX_CONCURRENCY = int(os.getenv("PURGE_MAX_CONCURRENCY", "2"))
+PURGE_JITTER_RATIO = 0.1
+
+class PurgeJob:
+    __slots__ = ("channel_id", "interval", "keep_hours", "batch_limit",
+                 "next_run", "last_run", "last_deleted", "deleted_total", "running")
+
+    def __init__(self, channel_id: int, interval: int, keep_hours: int, batch_limit: int):
+        self.channel_id = channel_id
+        self.interval = interval
+        self.keep_hours = keep_hours
+        self.batch_limit = batch_limit
+        self.next_run = 0.0
+        self.last_run: float | None = None
+        self.last_deleted = 0
+        self.deleted_total = 0
+        self.running = False
+
+class PurgeSupervisor:
+    """チャンネルごとの掃除ジョブを優先度キュー（次回実行時刻）で管理する。"""
+    def __init__(self, client: commands.Bot, max_concurrency: int):
+        self.client = client
+        self.jobs: dict[int, PurgeJob] = {}
+        self._heap: list[tuple[float, int]] = []
+        self._sem = asyncio.Semaphore(max(1, max_concurrency))
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._active: dict[int, asyncio.Task] = {}
+
+    def _push(self, job: PurgeJob):
+        job.next_run = time.time() + job.interval + random.uniform(0, job.interval * PURGE_JITTER_RATIO)
+        heapq.heappush(self._heap, (job.next_run, job.channel_id))
+        self._wakeup.set()
+
+    def add(self, channel_id: int, interval: int, keep_hours: int, batch_limit: int):
+        self.remove(channel_id)
+        job = PurgeJob(channel_id, interval, keep_hours, batch_limit)
+        self.jobs[channel_id] = job
+        self._push(job)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def remove(self, channel_id: int):
+        # ヒープ上の古い項目は取り出し時に捨てる
+        self.jobs.pop(channel_id, None)
+        t = self._active.pop(channel_id, None)
+        if t and not t.done():
+            t.cancel()
+
+    async def _run(self):
+        while True:
+            try:
+                self._wakeup.clear()
+                if not self._heap:
+                    await self._wakeup.wait()
+                    continue
+                due, ch_id = self._heap[0]
+                delay = due - time.time()
+                if delay > 0:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                heapq.heappop(self._heap)
+                job = self.jobs.get(ch_id)
+                if job is None or job.next_run != due or job.running:
+                    continue
+                self._active[ch_id] = asyncio.create_task(self._run_job(job))
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                log.exception(f"[purge] supervisor error: {e}")
+
+    async def _run_job(self, job: PurgeJob):
+        try:
+            async with self._sem:
+                if self.jobs.get(job.channel_id) is not job:
+                    return
+                ch = self.client.get_channel(job.channel_id)
+                if not isinstance(ch, discord.TextChannel):
+                    return
+                job.running = True
+                job.last_run = time.time()
+                start = time.perf_counter()
+                try:
+                    job.last_deleted = await _purge_once(ch, job.keep_hours, job.batch_limit)
+                    job.deleted_total += job.last_deleted
+                    metrics.inc("purge_deleted_total", job.last_deleted)
+                except Exception as e:
+                    metrics.inc("purge_errors_total")
+                    log.exception(f"[purge] error in channel {job.channel_id}: {e}")
+                finally:
+                    job.running = False
+                    metrics.observe("purge_cycle_seconds", time.perf_counter() - start)
+        finally:
+            if self.jobs.get(job.channel_id) is job:
+                self._active.pop(job.channel_id, None)
+                self._push(job)
+
+async def start_purge_for_channel(bot: commands.Bot, channel_id: int, interval_sec: int, keep_hours: int, batch_limit: int):
+    await stop_purge_for_channel(channel_id)
+    ch = bot.get_channel(channel_id)
+    if not isinstance(ch, discord.TextChannel) or not owns_guild(bot, ch.guild.id):
+        return
+    purge_supervisor.add(channel_id, interval_sec, keep_hours, batch_limit)
+
+async def stop_purge_for_channel(channel_id: int):
+    purge_supervisor.remove(channel_id)
+
+# ========= 保持期間・コンパクション =========
+# 投稿記録（reveal用）は掲示板ごとの保持日数を過ぎたら削除。未設定なら POST_RETENTION_DAYS（0=無期限）。
+# 承認待ちは日数では消さず、承認しても反映先が無いもの（孤児）だけを削除する:
+#   壊れた記録 / 本文の投稿記録が既に無い（保持期間切れ・削除済み） / カードの置き場所（ログチャンネル）が記録にも設定にも無い
+# PENDING_MAX_DAYS>0 なら、それより古いカードも削除する（既定は無効）。
+POST_RETENTION_DAYS = int(os.getenv("POST_RETENTION_DAYS", "0"))
+PENDING_MAX_DAYS = int(os.getenv("PENDING_MAX_DAYS", "0"))
+PENDING_ORPHAN_GRACE = datetime.timedelta(hours=1)  # 投稿記録の書き込みと承認カードの送信は並行なので、直後は判断しない
+COMPACT_INTERVAL = float(os.getenv("COMPACT_INTERVAL", "3600"))
+COMPACT_BATCH = 200
+
+def retention_days_for(chid: int, retention: dict[int, int] | None = None) -> int:
+    """retention（load_retention_days の結果）を渡すとそちらを、なければこのプロセスのキャッシュを見る。"""
+    days = retention.get(chid) if retention is not None else getattr(channel_config(chid), "retention_days", None)
+    return days or POST_RETENTION_DAYS
+
+async def load_retention_days() -> dict[int, int]:
+    """保持日数の設定を共有ストアから読み直す。削除の判断は、別プロセスで変えた設定も含めた最新値で行う。"""
+    prefix = RETENTION_KEY.split("{")[0]
+    out: dict[int, int] = {}
+    async for k, v in kv_scan(prefix):
+        try:
+            out[int(k[len(prefix):])] = int(v)
+        except ValueError:
+            continue
+    return out
+
+def _message_age(mid: int, now: datetime.datetime) -> datetime.timedelta:
+    return now - discord.utils.snowflake_time(mid)
+
+def _post_expired(key: str, value: str, now: datetime.datetime, retention: dict[int, int]) -> bool:
+    try:
+        post = PostRecord.decode(int(key[len(POSTMAP_PREFIX):]), value)
+    except Exception:
+        return True  # 壊れた記録
+    days = retention_days_for(post.channel_id, retention)
+    return days > 0 and _message_age(post.message_id, now) > datetime.timedelta(days=days)
+
+def _author_index_expired(key: str, value: str, now: datetime.datetime, retention: dict[int, int]) -> bool:
+    try:
+        chid = int(key[len(AUTHOR_INDEX_PREFIX):].split(":", 1)[0])
+        mid = int(value)
+    except Exception:
+        return True
+    days = retention_days_for(chid, retention)
+    return days > 0 and _message_age(mid, now) > datetime.timedelta(days=days)
+
+def _pending_orphaned(rec: PendingRecord, post_exists: bool, now: datetime.datetime) -> bool:
+    age = _message_age(rec.log_message_id, now)
+    if PENDING_MAX_DAYS > 0 and age > datetime.timedelta(days=PENDING_MAX_DAYS):
+        return True
+    if age < PENDING_ORPHAN_GRACE:
+        return False
+    if not post_exists:
+        return True  # 本文の投稿記録が無い → 承認しても反映先が無い
+    cfg = channel_config(rec.board_channel_id)
+    return rec.log_channel_id is None and (cfg is None or cfg.log_channel_id is None)
+
+async def _compact_pending() -> int:
+    """承認待ちを小分けに読み、本文の投稿記録の有無をまとめて引いて孤児を削除する。"""
+    now = discord.utils.utcnow()
+    removed = 0
+
+    async def sweep(batch: list[tuple[str, PendingRecord | None]]) -> int:
+        posts = await kv_get_many([gkey_postmap(r.board_message_id) for _, r in batch if r is not None])
+        dead = [k for k, r in batch
+                if r is None or _pending_orphaned(r, gkey_postmap(r.board_message_id) in posts, now)]
+        if dead:
+            await kv_del_many(dead)
+            _forget_pending(dead)
+        return len(dead)
+
+    batch: list[tuple[str, PendingRecord | None]] = []
+    async for k, v in kv_scan(PENDING_PREFIX):
+        try:
+            batch.append((k, PendingRecord.decode(int(k[len(PENDING_PREFIX):]), v)))
+        except Exception:
+            batch.append((k, None))  # 壊れた記録
+        if len(batch) >= COMPACT_BATCH:
+            removed += await sweep(batch)
+            batch = []
+            await asyncio.sleep(0)
+    if batch:
+        removed += await sweep(batch)
+    return removed
+
+async def _compact_prefix(prefix: str, expired, retention: dict[int, int]) -> int:
+    """prefix の記録を流し読みし、expired(key, value, now, retention) が真のものを小分けに削除する。"""
+    now = discord.utils.utcnow()
+    batch: list[str] = []
+    removed = 0
+    async for k, v in kv_scan(prefix):
+        if expired(k, v, now, retention):
+            batch.append(k)
+        if len(batch) >= COMPACT_BATCH:
+            await kv_del_many(batch)
+            removed += len(batch)
+            batch = []
+            await asyncio.sleep(0)  # 他の処理に譲る
+    if batch:
+        await kv_del_many(batch)
+        removed += len(batch)
+    return removed
+
+def _forget_pending(keys: list[str]):
+    for k in keys:
+        try:
+            _pending.pop(int(k[len(PENDING_PREFIX):]), None)
+        except ValueError:
+            pass
+
+_claims_seen: set[str] = set()  # 前回のコンパクションで見た処理中の印
+
+async def _compact_claims() -> int:
+    """前回のコンパクション（COMPACT_INTERVAL 前）から残り続けている処理中の印は、落ちたプロセスの名残として外す。"""
+    global _claims_seen
+    current = {k async for k, _ in kv_scan(PENDING_CLAIM_PREFIX)}
+    stale = sorted(current & _claims_seen)
+    await kv_del_many(stale)
+    _claims_seen = current - set(stale)
+    return len(stale)
+
+async def compact_store() -> dict[str, int]:
+    retention = await load_retention_days()
+    posts = await _compact_prefix(POSTMAP_PREFIX, _post_expired, retention)
+    index = await _compact_prefix(AUTHOR_INDEX_PREFIX, _author_index_expired, retention)
+    pending = await _compact_pending()  # 投稿記録の削除後に見る（期限切れの投稿のカードも同じ回で消える）
+    claims = await _compact_claims()
+    metrics.inc("compact_removed_total", posts, kind="post")
+    metrics.inc("compact_removed_total", index, kind="author_index")
+    metrics.inc("compact_removed_total", pending, kind="pending")
+    metrics.inc("compact_removed_total", claims, kind="claim")
+    if posts or index or pending or claims:
+        log.info(f"[compact] removed posts={posts} author_index={index} pending={pending} claims={claims}")
+    return {"post": posts, "author_index": index, "pending": pending, "claim": claims}
+
+async def _compact_loop():
+    while True:
+        await asyncio.sleep(COMPACT_INTERVAL)
+        try:
+            await compact_store()
+        except Exception as e:
+            log.exception(f"[compact] error: {e}")
+
+async def backfill_author_index():
+    """索引導入前の投稿記録から投稿者索引を作る（1回だけ）。旧形式の guild_id もここでチャンネル設定に移す。"""
+    if await kv_get(AUTHOR_INDEX_DONE_KEY):
+        return
+    batch: dict[str, str] = {}
+    total = 0
+    async for k, v in kv_scan(POSTMAP_PREFIX):
+        try:
+            post = PostRecord.decode(int(k[len(POSTMAP_PREFIX):]), v)
+        except Exception:
+            continue
+        await remember_channel_guild(post.channel_id, _legacy_guild_id(v))
+        batch[gkey_author_index(post.channel_id, post.author_id, post.message_id)] = str(post.message_id)
+        if len(batch) >= COMPACT_BATCH:
+            await kv_set_many(batch)
+            total += len(batch)
+            batch = {}
+    await kv_set_many(batch)
+    total += len(batch)
+    await kv_set(AUTHOR_INDEX_DONE_KEY, "1")
+    if total:
+        log.info(f"[index] backfilled {total} author index entries")
+
+async def author_posts_page(chid: int, author_id: int, offset: int, limit: int) -> tuple[list[int], bool]:
+    """投稿者の投稿IDを新しい順に offset から limit 件。2つ目は続きがあるか。"""
+    out: list[int] = []
+    n = 0
+    async for _, v in kv_scan(author_index_prefix(chid, author_id), page=min(offset + limit + 1, 500)):
+        if n >= offset:
+            if len(out) >= limit:
+                return out, True
+            out.append(int(v))
+        n += 1
+    return out, False
+
+async def store_stats_by_prefix() -> dict[str, tuple[int, int]]:
+    """キー先頭2区切り（例: anonboard:post）ごとの (件数, バイト数)。全件を流し読みする。"""
+    out: dict[str, list[int]] = {}
+    async for k, v in kv_scan(""):
+        prefix = ":".join(k.split(":", 2)[:2])
+        row = out.setdefault(prefix, [0, 0])
+        row[0] += 1
+        row[1] += len(k.encode("utf-8")) + len(v.encode("utf-8"))
+    return {p: (c, b) for p, (c, b) in out.items()}
+
+# ========= 投稿記録の書き出し =========
+# 掲示板1つ分の投稿記録をキー順に流し読みし、gzip 圧縮の JSONL に追記する。メモリに持つのは1ページ分だけ。
+# ページごとに完結した gzip メンバーとして追記・fsync してから「最後のメッセージID と ファイル長」を保存する。
+# 次回はファイルをその長さに切り詰めてから（書きかけのメンバーを捨てて）キーの続きから再開する。
+# 本文も含める場合は、ページのID範囲だけ channel.history で取得する。
+EXPORT_DIR = os.getenv("EXPORT_DIR", "exports")
+EXPORT_PAGE = 100  # history の1リクエスト分
+EXPORT_CURSOR_KEY = "anonboard:export_cursor:{channel_id}"  # 値: "最後のメッセージID ファイル長"
+def gkey_export_cursor(chid: int) -> str: return EXPORT_CURSOR_KEY.format(channel_id=chid)
+
+_export_tasks: dict[int, asyncio.Task] = {}
+_export_progress: dict[int, int] = {}  # channel_id -> 今回書き出した件数
+
+def export_path(chid: int) -> str:
+    return os.path.join(EXPORT_DIR, f"anonboard-{chid}.jsonl.gz")
+
+def _append_member(f, data: bytes) -> int:
+    """1ページを完結した gzip メンバーとして追記し、ディスクまで書いてからファイル長を返す。"""
+    f.write(gzip.compress(data))
+    f.flush()
+    os.fsync(f.fileno())
+    return f.tell()
+
+def _open_for_append(path: str, length: int | None):
+    f = open(path, "ab")
+    if length is not None and f.tell() > length:
+        f.truncate(length)  # 前回カーソル保存後に書きかけたメンバーを捨てる
+        f.seek(length)
+    return f
+
+async def _live_messages(channel: discord.TextChannel, first_id: int, last_id: int) -> dict[int, discord.Message]:
+    out: dict[int, discord.Message] = {}
+    async for m in channel.history(limit=None, after=discord.Object(id=first_id - 1),
+                                   before=discord.Object(id=last_id + 1), oldest_first=True):
+        out[m.id] = m
+    return out
+
+def _export_row(post: PostRecord, live: dict[int, discord.Message] | None) -> dict:
+    row = {
+        "message_id": post.message_id,
+        "channel_id": post.channel_id,
+        "created_at": discord.utils.snowflake_time(post.message_id).isoformat(),
+        "author_id": post.author_id,
+        "author_name": post.author_name,
+        "author_display": post.author_display,
+        "anonymous": post.anonymous,
+        "anon_display": post.anon_display,
+        "img_url": post.img_url,
+    }
+    if live is not None:
+        m = live.get(post.message_id)
+        e = m.embeds[0] if (m and m.embeds) else None
+        row["deleted"] = m is None
+        row["content"] = (e.description if e else m.content) if m else None
+        row["image_url"] = getattr(e.image, "url", None) if e else None
+    return row
+
+async def _export_page(f, chid: int, channel: discord.TextChannel | None, page: list[PostRecord]):
+    live = None
+    if channel is not None:
+        ids = [p.message_id for p in page]
+        live = await _live_messages(channel, min(ids), max(ids))
+    data = "".join(json.dumps(_export_row(p, live), ensure_ascii=False) + "\n" for p in page).encode("utf-8")
+    length = await asyncio.to_thread(_append_member, f, data)
+    await kv_set(gkey_export_cursor(chid), f"{page[-1].message_id} {length}")
+    _export_progress[chid] = _export_progress.get(chid, 0) + len(page)
+
+async def export_board(client: commands.Bot, chid: int, with_content: bool) -> int:
+    """前回の続きから書き出して、今回書き出した件数を返す。"""
+    channel = client.get_channel(chid) if with_content else None
+    if with_content and not isinstance(channel, discord.TextChannel):
+        raise RuntimeError("掲示板チャンネルが見つかりません")
+    cursor_mid, _, length = (await kv_get(gkey_export_cursor(chid)) or "").partition(" ")
+    _export_progress[chid] = 0
+    await asyncio.to_thread(os.makedirs, EXPORT_DIR, exist_ok=True)
+    # メンバーを足していくだけなので、gzip.open などでそのまま1本として読める
+    f = await asyncio.to_thread(_open_for_append, export_path(chid), int(length) if length else None)
+    try:
+        page: list[PostRecord] = []
+        async for k, v in kv_scan(POSTMAP_PREFIX, after=gkey_postmap(int(cursor_mid)) if cursor_mid else None):
+            try:
+                post = PostRecord.decode(int(k[len(POSTMAP_PREFIX):]), v)
+            except Exception:
+                continue
+            if post.channel_id != chid:
+                continue
+            page.append(post)
+            if len(page) >= EXPORT_PAGE:
+                await _export_page(f, chid, channel, page)
+                page = []
+        if page:
+            await _export_page(f, chid, channel, page)
+    finally:
+        await asyncio.to_thread(f.close)
+    return _export_progress[chid]
+
+async def reset_export(chid: int):
+    await kv_del(gkey_export_cursor(chid))
+    try:
+        os.remove(export_path(chid))
+    except FileNotFoundError:
+        pass
+
+# ========= Webhook 投稿 =========
+# 有効にした掲示板では、本文を bot 管理の Webhook から匿名番号をユーザー名にして投稿する。
+# Webhook はチャンネル送信と別のレート制限枠なので、パネル再掲・ログ・掃除に押されない。
+# KVには Webhook ID だけを持ち、トークン付きの実体はプロセスごとに1回だけ取得する。
+WEBHOOK_NAME = "匿名掲示板"
+_webhooks: dict[int, discord.Webhook] = {}  # Webhook ID -> 取得済み
+_webhook_locks: dict[int, asyncio.Lock] = {}  # 掲示板ID -> 作成/取得の排他
+
+async def fetch_board_webhook(client: commands.Bot, webhook_id: int) -> discord.Webhook | None:
+    wh = _webhooks.get(webhook_id)
+    if wh is None:
+        try:
+            wh = await client.fetch_webhook(webhook_id)
+        except discord.NotFound:
+            return None
+        if wh.token is None:  # 他者の Webhook では投稿できない
+            return None
+        _webhooks[webhook_id] = wh
+    return wh
+
+async def enable_board_webhook(client: commands.Bot, board_ch: discord.TextChannel) -> discord.Webhook:
+    """掲示板の Webhook を用意して ID を保存する。bot が以前作ったものが残っていれば使い回す。"""
+    async with _webhook_locks.setdefault(board_ch.id, asyncio.Lock()):
+        cfg = channel_config(board_ch.id)
+        wh = await fetch_board_webhook(client, cfg.webhook_id) if (cfg and cfg.webhook_id) else None
+        if wh is None:
+            for cand in await board_ch.webhooks():
+                if cand.token and client.user and cand.user and cand.user.id == client.user.id:
+                    wh = _webhooks[cand.id] = cand
+                    break
+        if wh is None:
+            wh = await board_ch.create_webhook(name=WEBHOOK_NAME, reason="匿名掲示板の投稿用")
+            _webhooks[wh.id] = wh
+        if not (cfg and cfg.webhook_id == wh.id):
+            await set_channel_config(board_ch.id, "webhook_id", wh.id)
+        return wh
+
+async def board_webhook(client: commands.Bot, board_ch: discord.TextChannel) -> discord.Webhook | None:
+    """Webhook 公開が有効ならその Webhook。消されていたら作り直す。"""
+    cfg = channel_config(board_ch.id)
+    if not (cfg and cfg.webhook_id):
+        return None
+    wh = _webhooks.get(cfg.webhook_id)
+    if wh is not None:
+        return wh
+    return await enable_board_webhook(client, board_ch)
+
+async def publish_post(
+    client: commands.Bot, board_ch: discord.TextChannel, embed: discord.Embed, username: str
+) -> tuple[discord.Message, int | None]:
+    """本文を公開する。戻り値は (メッセージ, 使った Webhook ID)。Webhook が使えなければ通常送信。"""
+    try:
+        wh = await board_webhook(client, board_ch)
+    except discord.HTTPException as e:
+        log.warning(f"[webhook] unavailable for {board_ch.id}: {e!r}")
+        wh = None
+    if wh is not None:
+        try:
+            msg = await rest(PRIO_INTERACTIVE, f"webhook:{board_ch.id}",
+                             lambda: wh.send(embed=embed, username=username[:80], wait=True))
+            return msg, wh.id
+        except discord.NotFound:
+            _webhooks.pop(wh.id, None)  # 消された → 次の投稿で作り直す
+        except discord.HTTPException as e:
+            log.warning(f"[webhook] send failed for {board_ch.id}: {e!r}")
+    msg = await rest(PRIO_INTERACTIVE, f"send:{board_ch.id}", lambda: board_ch.send(embed=embed))
+    return msg, None
+
+# ========= 画像承認キュー =========
+# 承認待ちはメモリに持ち、ボタン操作・一括処理でKVを引かない（見つからないときだけKVを見る）。
+_pending: dict[int, PendingRecord] = {}  # log_message_id -> 承認待ち
+
+APPROVAL_STATES = {
+    "pending": ("🕒 画像承認リクエスト", discord.Color.orange()),
+    "approved": ("✅ 承認・反映済み", discord.Color.green()),
+    "rejected": ("⛔ 実施せず（本文は公開済み）", discord.Color.red()),
+}
+
+def approval_card_embed(rec: PendingRecord, guild_id: int | None, state: str) -> discord.Embed:
+    title, color = APPROVAL_STATES[state]
+    e = discord.Embed(title=title, description=rec.content, color=color)
+    e.add_field(name="匿名？", value="はい" if rec.anonymous else "いいえ", inline=True)
+    e.add_field(name="表示名", value=rec.display_name, inline=True)
+    e.add_field(name="投稿先", value=f"<#{rec.board_channel_id}>", inline=True)
+    jump = f"https://discord.com/channels/{guild_id or '@me'}/{rec.board_channel_id}/{rec.board_message_id}"
+    e.add_field(name="本文メッセージ", value=f"[ジャンプ]({jump})", inline=False)
+    e.add_field(name="送信者", value=f"<@{rec.author_id}> ({rec.author_id})", inline=False)
+    if rec.img_meta:
+        e.add_field(name="画像", value=rec.img_meta, inline=False)
+    if rec.img_url:
+        e.set_image(url=rec.img_url)
+    return e
+
+async def load_pending_queue():
+    """起動時に承認待ちをメモリに載せる。旧形式の記録はここで一度だけ新形式に書き換える。"""
+    migrated: dict[str, str] = {}
+    async for k, v in kv_scan(PENDING_PREFIX):
+        try:
+            rec = PendingRecord.decode(int(k[len(PENDING_PREFIX):]), v)
+        except Exception:
+            continue
+        await remember_channel_guild(rec.board_channel_id, _legacy_guild_id(v))
+        if rec.log_channel_id is None:
+            cfg = channel_config(rec.board_channel_id)
+            rec.log_channel_id = cfg.log_channel_id if cfg else None
+        _pending[rec.log_message_id] = rec
+        encoded = rec.encode()
+        if encoded != v:
+            migrated[k] = encoded
+    await kv_set_many(migrated)
+    if not SHARD_IDS:
+        # ストアを使うのはこのプロセスだけ → 残っている処理中の印は前回の異常終了の名残
+        await kv_del_many([k async for k, _ in kv_scan(PENDING_CLAIM_PREFIX)])
+    if _pending:
+        log.info(f"[approval] loaded {len(_pending)} pending cards (migrated {len(migrated)})")
+
+async def claim_pending(log_mid: int) -> PendingRecord | None:
+    """承認待ちを処理のために押さえる。処理中の印を最初に立てた1回だけが受け取る（同時押し・複数プロセスでの二重処理を防ぐ）。
+    記録そのものは反映し終わるまで消さない（途中で落ちても承認待ちのまま残る）。"""
+    rec = _pending.pop(log_mid, None)
+    v = await kv_get(gkey_pending(log_mid))
+    if v is None:
+        return None  # 処理済み（他プロセスで処理された分がメモリに残っていた場合も）
+    if await kv_incr(gkey_pending_claim(log_mid)) != 1:
+        return None  # 他で処理中
+    if rec is None:
+        try:
+            rec = PendingRecord.decode(log_mid, v)
+        except Exception:
+            await kv_del(gkey_pending_claim(log_mid))
+            return None
+    return rec
+
+def add_pending(rec: PendingRecord):
+    _pending[rec.log_message_id] = rec
+
+async def requeue_pending(rec: PendingRecord):
+    """処理できなかった承認待ちをキューに戻し、処理中の印を外す（KVの記録は残したまま）。"""
+    add_pending(rec)
+    await kv_del(gkey_pending_claim(rec.log_message_id))
+
+async def finish_pending(rec: PendingRecord):
+    """反映し終えた承認待ちの記録と処理中の印を消す。"""
+    await kv_del_many([gkey_pending(rec.log_message_id), gkey_pending_claim(rec.log_message_id)])
+
+async def resolve_pending(
+    client: commands.Bot, rec: PendingRecord, approve: bool, priority: int = PRIO_INTERACTIVE
+) -> str | None:
+    """claim_pending で押さえた承認待ちを承認/却下して反映し、終わったらKVの記録を消す。
+    失敗時は利用者向けメッセージを返し、キューに戻して処理中の印を外す。"""
+    board_ch = client.get_channel(rec.board_channel_id)
+    board_cfg = channel_config(rec.board_channel_id)
+    guild_id = board_cfg.guild_id if board_cfg else None
+    if approve:
+        if not isinstance(board_ch, discord.TextChannel):
+            await requeue_pending(rec)
+            return "投稿先チャンネルが見つかりません。"
+        new_embed = discord.Embed(description=rec.content, color=discord.Color.blurple())
+        new_embed.set_footer(text=f"投稿者: {rec.display_name}")
+        if rec.img_url:
+            new_embed.set_image(url=rec.img_url)
+        try:
+            if rec.webhook_id:
+                # Webhook の投稿は bot 自身では編集できないので、同じ Webhook から
+                wh = await fetch_board_webhook(client, rec.webhook_id)
+                if wh is None:
+                    await requeue_pending(rec)
+                    return "投稿に使った Webhook が見つからないため、本文を更新できません。"
+                await rest(priority, f"webhook:{board_ch.id}",
+                           lambda: wh.edit_message(rec.board_message_id, embed=new_embed))
+            else:
+                target = board_ch.get_partial_message(rec.board_message_id)
+                await rest(priority, f"edit:{board_ch.id}", lambda: target.edit(embed=new_embed))
+        except Exception:
+            await requeue_pending(rec)
+            return "本文メッセージを更新できませんでした。"
+
+        post_s = await kv_get(gkey_postmap(rec.board_message_id))
+        if post_s:
+            post = PostRecord.decode(rec.board_message_id, post_s)
+            post.img_url = rec.img_url or None
+            await kv_set(gkey_postmap(rec.board_message_id), post.encode())
+    await finish_pending(rec)
+
+    log_chid = rec.log_channel_id
+    if log_chid is None and board_cfg:
+        log_chid = board_cfg.log_channel_id
+    log_ch = client.get_channel(log_chid) if log_chid else None
+    if isinstance(log_ch, discord.TextChannel):
+        card = approval_card_embed(rec, guild_id, "approved" if approve else "rejected")
+        view = ApprovalView(rec.board_channel_id, disabled=True)
+        card_msg = log_ch.get_partial_message(rec.log_message_id)
+        try:
+            await rest(priority, f"edit:{log_ch.id}", lambda: card_msg.edit(embed=card, view=view))
+        except Exception as e:
+            log.warning(f"[approval] card edit failed for {rec.log_message_id}: {e!r}")
+
+    return None
+
+async def resolve_all_pending(client: commands.Bot, board_chid: int, approve: bool) -> tuple[int, int]:
+    """掲示板1つ分の承認待ちをまとめて処理する（RESTは送信キューの同時実行数の範囲で並行）。
+    件数が多くても利用者の投稿を待たせないよう、ログ送信と同じ優先度で流す。"""
+    mids = [r.log_message_id for r in _pending.values() if r.board_channel_id == board_chid]
+    recs = [r for r in await asyncio.gather(*(claim_pending(m) for m in mids)) if r is not None]
+    results = await asyncio.gather(*(resolve_pending(client, r, approve, PRIO_LOG) for r in recs), return_exceptions=True)
+    failed = 0
+    for rec, r in zip(recs, results):
+        if isinstance(r, Exception):
+            await requeue_pending(rec)
+            log.error(f"[approval] failed for {rec.log_message_id}: {r!r}", exc_info=r)
+        if r is not None:
+            failed += 1
+    return len(recs) - failed, failed
+
+# ========= URL/メッセージリンク 解析 =========
+IMAGE_EXT_RE = re.compile(r"\.(?:png|jpg|jpeg|gif|webp)(?:\?.*)?$", re.IGNORECASE)
+URL_RE = re.compile(r"https?://[^\s]+", re.IGNORECASE)
+
+def is_image_url(url: str) -> bool:
+    if IMAGE_EXT_RE.search(url):
+        return True
+    cdn_like = ("cdn.discordapp.com", "media.discordapp.net", "images-ext", "pbs.twimg.com", "imgur.com")
+    return any(h in url for h in cdn_like)
+
+def extract_first_image_url(text: str) -> str | None:
+    for m in URL_RE.findall(text or ""):
+        if is_image_url(m):
+            return m
+    return None
+
+MSG_LINK_RE = re.compile(
+    r"https?://(?:ptb\.|canary\.)?discord\.com/channels/(?P<guild_id>\d+)/(?P<channel_id>\d+)/(?P<message_id>\d+)"
+)
+
+async def fetch_message_from_link(bot: commands.Bot, link: str) -> discord.Message | None:
+    m = MSG_LINK_RE.match(link.strip())
+    if not m:
+        return None
+    ch_id = int(m.group("channel_id"))
+    msg_id = int(m.group("message_id"))
+    ch = bot.get_channel(ch_id)
+    if not isinstance(ch, (discord.TextChannel, discord.Thread)):
+        return None
+    try:
+        return await ch.fetch_message(msg_id)
+    except Exception:
+        return None
+
+# ========= ログのまとめ送信 =========
+# 画像なし投稿のログをログ先ごとにため、一定時間ごと（または10件たまったら）1通にまとめて送る。
+# 承認カードはまとめずにすぐ送る。
+LOG_DIGEST_MAX_EMBEDS = 10    # 1メッセージに載せられる埋め込みの数
+LOG_DIGEST_MAX_CHARS = 6000   # 1メッセージの埋め込み合計文字数
+
+def _embed_chunks(embeds: list[discord.Embed]) -> list[list[discord.Embed]]:
+    chunks: list[list[discord.Embed]] = []
+    size = 0
+    for e in embeds:
+        n = len(e)
+        if not chunks or len(chunks[-1]) >= LOG_DIGEST_MAX_EMBEDS or size + n > LOG_DIGEST_MAX_CHARS:
+            chunks.append([])
+            size = 0
+        chunks[-1].append(e)
+        size += n
+    return chunks
+
+class LogDigest:
+    def __init__(self, client: "AnonBoardBot"):
+        self.client = client
+        self._buf: dict[int, list[discord.Embed]] = {}    # ログ先ID -> 未送信のログ
+        self._timers: dict[int, asyncio.Task] = {}
+
+    @staticmethod
+    def interval(log_ch_id: int) -> int:
+        cfg = channel_config(log_ch_id)
+        return (cfg.log_digest_sec or 0) if cfg else 0
+
+    def add(self, log_ch_id: int, embed: discord.Embed, delay: float):
+        buf = self._buf.setdefault(log_ch_id, [])
+        buf.append(embed)
+        if len(buf) >= LOG_DIGEST_MAX_EMBEDS:
+            self.client.spawn(self.flush(log_ch_id))
+        elif log_ch_id not in self._timers:
+            self._timers[log_ch_id] = self.client.spawn(self._flush_later(log_ch_id, delay))
+
+    async def _flush_later(self, log_ch_id: int, delay: float):
+        await asyncio.sleep(delay)
+        self._timers.pop(log_ch_id, None)
+        await self.flush(log_ch_id)
+
+    async def flush(self, log_ch_id: int):
+        t = self._timers.pop(log_ch_id, None)
+        if t is not None and t is not asyncio.current_task():
+            t.cancel()
+        embeds = self._buf.pop(log_ch_id, None)
+        if not embeds:
+            return
+        ch = self.client.get_channel(log_ch_id)
+        if not isinstance(ch, discord.TextChannel):
+            log.warning(f"[logdigest] log channel {log_ch_id} not found; dropped {len(embeds)} entries")
+            return
+        for chunk in _embed_chunks(embeds):
+            try:
+                await rest(PRIO_LOG, f"send:{log_ch_id}", lambda c=chunk: ch.send(embeds=c))
+                metrics.inc("log_digest_messages_total")
+                metrics.inc("log_digest_entries_total", len(chunk))
+            except Exception as e:
+                log.error(f"[logdigest] send failed for {log_ch_id}: {e!r}")
+
+    async def flush_all(self):
+        for chid in list(self._buf):
+            await self.flush(chid)
+
+# ========= 画像の事前確認 =========
+# 承認カードを出す前に画像URLの先頭だけ取得し、種類・サイズ・縦横を確かめる（壊れたリンクや巨大画像を弾く）。
+# 結果はURLごとに期限付きLRUで覚え、同じリンクの再投稿では取りに行かない。
+IMAGE_PROBE_ENABLED = os.getenv("IMAGE_PROBE", "1") != "0"
+IMAGE_PROBE_BYTES = int(os.getenv("IMAGE_PROBE_BYTES", "16384"))          # 先頭から読む量（縦横の判定用）
+IMAGE_PROBE_TIMEOUT = float(os.getenv("IMAGE_PROBE_TIMEOUT", "5.0"))
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(10 * 1024 * 1024)))
+IMAGE_CACHE_SIZE = int(os.getenv("IMAGE_CACHE_SIZE", "1024"))
+IMAGE_CACHE_TTL = float(os.getenv("IMAGE_CACHE_TTL", "3600"))
+IMAGE_PROBE_CONNECTIONS = int(os.getenv("IMAGE_PROBE_CONNECTIONS", "8"))
+IMAGE_PROBE_MAX_REDIRECTS = 3
+# 既定では内部アドレス（ループバック・プライベート・リンクローカル等）へは取りに行かない。ローカルでの試験用に 1 で許可
+IMAGE_PROBE_ALLOW_PRIVATE = os.getenv("IMAGE_PROBE_ALLOW_PRIVATE", "") == "1"
+CONTENT_RANGE_RE = re.compile(r"bytes\s+\d+-\d+/(\d+)")
+
+@dataclass(slots=True)
+class ImageInfo:
+    ok: bool
+    content_type: str = ""
+    size: int | None = None
+    width: int | None = None
+    height: int | None = None
+    error: str = ""
+    definitive: bool = True  # False: タイムアウト・5xx などこちら側で確かめきれなかった（ok も False）
+
+    def summary(self) -> str:
+        if not self.ok and not self.definitive:
+            return f"未確認（{self.error}）"
+        parts = []
+        if self.width and self.height:
+            parts.append(f"{self.width}×{self.height}")
+        if self.size is not None:
+            parts.append(f"{self.size / 1024:.1f}KB")
+        if self.content_type:
+            parts.append(self.content_type)
+        return " / ".join(parts) or "不明"
+
+def image_dimensions(head: bytes) -> tuple[int, int] | None:
+    """PNG / GIF / JPEG / WEBP の先頭バイトから (幅, 高さ) を読む。読めなければ None。"""
+    if head.startswith(b"\x89PNG\r\n\x1a\n") and len(head) >= 24:
+        return struct.unpack(">II", head[16:24])
+    if head[:6] in (b"GIF87a", b"GIF89a") and len(head) >= 10:
+        return struct.unpack("<HH", head[6:10])
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP" and len(head) >= 30:
+        chunk = head[12:16]
+        if chunk == b"VP8 ":
+            w, h = struct.unpack("<HH", head[26:30])
+            return w & 0x3FFF, h & 0x3FFF
+        if chunk == b"VP8L":
+            b = head[21:25]
+            w = 1 + (((b[1] & 0x3F) << 8) | b[0])
+            h = 1 + (((b[3] & 0x0F) << 10) | (b[2] << 2) | ((b[1] & 0xC0) >> 6))
+            return w, h
+        if chunk == b"VP8X":
+            return 1 + int.from_bytes(head[24:27], "little"), 1 + int.from_bytes(head[27:30], "little")
+        return None
+    if head[:2] == b"\xff\xd8":
+        i = 2
+        while i + 9 <= len(head):
+            if head[i] != 0xFF:
+                return None
+            marker = head[i + 1]
+            if marker == 0xFF:  # 詰め物
+                i += 1
+                continue
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):  # SOFn
+                h, w = struct.unpack(">HH", head[i + 5:i + 9])
+                return w, h
+            i += 2 + struct.unpack(">H", head[i + 2:i + 4])[0]
+    return None
+
+class BlockedAddress(Exception):
+    """画像URLの宛先が内部アドレスだった。"""
+
+def _is_public_ip(addr: str) -> bool:
+    ip = ipaddress.ip_address(addr.split("%", 1)[0])
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return ip.is_global
+
+def _check_literal_host(host: str):
+    """IPアドレス直書きは名前解決を通らないので、ここで確かめる。"""
+    try:
+        public = _is_public_ip(host)
+    except ValueError:
+        return  # ホスト名 → _PublicOnlyResolver で確かめる
+    if not public and not IMAGE_PROBE_ALLOW_PRIVATE:
+        raise BlockedAddress(host)
+
+class _PublicOnlyResolver(aiohttp.abc.AbstractResolver):
+    """名前解決の結果に内部アドレスが1つでも含まれていたら接続しない（リダイレクト先も同じ接続口を通る）。"""
+    def __init__(self):
+        self._inner = aiohttp.DefaultResolver()
+
+    async def resolve(self, host: str, port: int = 0, family: socket.AddressFamily = socket.AF_INET):
+        infos = await self._inner.resolve(host, port, family)
+        if not IMAGE_PROBE_ALLOW_PRIVATE and any(not _is_public_ip(i["host"]) for i in infos):
+            raise BlockedAddress(host)
+        return infos
+
+    async def close(self):
+        await self._inner.close()
+
+class ImageProber:
+    """画像URLの事前確認。接続はセッションで使い回し、同じURLの同時確認は1回にまとめる。"""
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._cache: OrderedDict[str, tuple[float, ImageInfo]] = OrderedDict()  # url -> (期限, 結果)
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._session: aiohttp.ClientSession | None = None
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=IMAGE_PROBE_CONNECTIONS, ttl_dns_cache=300, resolver=_PublicOnlyResolver()
+                ),
+                timeout=aiohttp.ClientTimeout(total=IMAGE_PROBE_TIMEOUT),
+            )
+        return self._session
+
+    def cached(self, url: str) -> ImageInfo | None:
+        hit = self._cache.get(url)
+        if hit is None:
+            return None
+        if hit[0] < time.monotonic():
+            del self._cache[url]
+            return None
+        self._cache.move_to_end(url)
+        return hit[1]
+
+    def _remember(self, url: str, info: ImageInfo):
+        self._cache[url] = (time.monotonic() + self.ttl, info)
+        self._cache.move_to_end(url)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    async def probe(self, url: str) -> ImageInfo:
+        info = self.cached(url)
+        if info is not None:
+            metrics.inc("image_probe_total", result="cache")
+            return info
+        fut = self._inflight.get(url)
+        if fut is not None:
+            return await asyncio.shield(fut)
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[url] = fut
+        start = time.perf_counter()
+        info = ImageInfo(False, error="確認が中断されました")
+        try:
+            info, definitive = await self._fetch(url)
+        except BlockedAddress:
+            info, definitive = ImageInfo(False, error="内部アドレスの画像は使えません"), True
+        except Exception as e:
+            # タイムアウト・接続失敗などは一時的なものとして覚えない
+            info, definitive = ImageInfo(False, error=f"取得できませんでした（{type(e).__name__}）"), False
+        finally:
+            # 中断されても、同じURLを待っている他の投稿は必ず起こす
+            del self._inflight[url]
+            if not fut.done():
+                fut.set_result(info)
+        info.definitive = definitive
+        metrics.observe("image_probe_seconds", time.perf_counter() - start)
+        metrics.inc("image_probe_total", result="ok" if info.ok else "rejected" if definitive else "unverified")
+        if definitive:
+            self._remember(url, info)
+        return info
+
+    async def _fetch(self, url: str) -> tuple[ImageInfo, bool]:
+        """(結果, キャッシュしてよいか) を返す。リダイレクトは1回ずつ宛先を確かめながらたどる。"""
+        headers = {"Range": f"bytes=0-{IMAGE_PROBE_BYTES - 1}"}
+        for _ in range(IMAGE_PROBE_MAX_REDIRECTS + 1):
+            if not url.lower().startswith(("http://", "https://")):
+                return ImageInfo(False, error="http(s) のURLではありません"), True
+            _check_literal_host(urlsplit(url).hostname or "")
+            async with self._get_session().get(url, headers=headers, allow_redirects=False) as resp:
+                if resp.status in (301, 302, 303, 307, 308) and resp.headers.get("Location"):
+                    url = urljoin(str(resp.url), resp.headers["Location"])
+                    continue
+                return await self._inspect(resp)
+        return ImageInfo(False, error="リダイレクトが多すぎます"), True
+
+    async def _inspect(self, resp: aiohttp.ClientResponse) -> tuple[ImageInfo, bool]:
+        if resp.status not in (200, 206):
+            transient = resp.status >= 500 or resp.status in (408, 429)
+            return ImageInfo(False, error=f"HTTP {resp.status}"), not transient
+        ctype = (resp.headers.get("Content-Type") or "").split(";")[0].strip().lower()
+        size = None
+        m = CONTENT_RANGE_RE.match(resp.headers.get("Content-Range") or "")
+        if m:
+            size = int(m.group(1))
+        elif resp.status == 200 and resp.content_length is not None:
+            size = resp.content_length  # Range 非対応のサーバー（先頭だけ読んで切る）
+        head = await resp.content.read(IMAGE_PROBE_BYTES)
+        dims = image_dimensions(head)
+        info = ImageInfo(True, ctype, size, *(dims or (None, None)))
+        if not ctype.startswith("image/"):
+            info.ok, info.error = False, f"画像ではありません（{ctype or '種類不明'}）"
+        elif size is not None and size > IMAGE_MAX_BYTES:
+            info.ok, info.error = False, f"大きすぎます（{size / 1024 / 1024:.1f}MB > {IMAGE_MAX_BYTES / 1024 / 1024:.0f}MB）"
+        return info, True
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+image_prober = ImageProber(IMAGE_CACHE_SIZE, IMAGE_CACHE_TTL)
+
+# ========= Discord =========
+# LEAN_PROFILE=1: 長時間動かす向けの省メモリ設定（メッセージキャッシュなし・メンバーは自分だけ・最小限の intents）
+LEAN_PROFILE = os.getenv("LEAN_PROFILE", "") == "1"
+MAX_MESSAGES = int(os.getenv("MAX_MESSAGES", "0" if LEAN_PROFILE else "1000"))  # 0 でメッセージキャッシュなし
+
+if LEAN_PROFILE:
+    # 使うのはチャンネル情報（guilds）と自動削除の on_message（guild_messages）だけ。本文は読まない
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.guild_messages = True
+else:
+    intents = discord.Intents.default()
+    intents.message_content = True
+    intents.guilds = True
+
+_client_kwargs = {"max_messages": MAX_MESSAGES or None}
+if LEAN_PROFILE:
+    _client_kwargs.update(member_cache_flags=discord.MemberCacheFlags.none(), chunk_guilds_at_startup=False)
+
+def is_sharded(client) -> bool:
+    return (getattr(client, "shard_count", None) or 1) > 1
+
+def owns_guild(client, guild_id: int | None) -> bool:
+    """このプロセスがギルドの担当シャードを持っているか（シャード分割なし・ギルド不明なら True）。"""
+    count = getattr(client, "shard_count", None) or 1
+    if count <= 1 or not guild_id:
+        return True
+    shard_ids = getattr(client, "shard_ids", None)
+    return shard_ids is None or (guild_id >> 22) % count in shard_ids
+
+def is_primary_shard(client) -> bool:
+    """全体で1回だけ動かす処理（コマンド同期・コンパクションなど）はシャード0を持つプロセスが担当。"""
+    shard_ids = getattr(client, "shard_ids", None)
+    return not is_sharded(client) or shard_ids is None or 0 in shard_ids
+
+class AnonBoardBot(commands.AutoShardedBot if SHARD_COUNT else commands.Bot):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._bg_tasks: set[asyncio.Task] = set()
+        self._shutdown_task: asyncio.Task | None = None
+
+    def spawn(self, coro) -> asyncio.Task:
+        """バックグラウンドタスクを起動し、終わるまで参照を持っておく。"""
+        t = asyncio.create_task(coro)
+        self._bg_tasks.add(t)
+        t.add_done_callback(self._bg_tasks.discard)
+        return t
+
+    async def setup_hook(self):
+        # 永続ビューのボタン（custom_id のテンプレート）を1回だけ登録
+        self.add_dynamic_items(PostButton, ApproveButton, RejectButton)
+        # Client.run は KeyboardInterrupt しか拾わないので、SIGTERM（再デプロイ時）でも close() を通す
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, lambda: self.spawn(self.close()))
+            except (NotImplementedError, RuntimeError):
+                pass  # Windows など
+        await startup(self)
+
+    async def close(self):
+        # SIGTERM 経由の close 中に Client.run からもう一度呼ばれるので、2回目以降は同じ終了処理を待つ
+        if self._shutdown_task is None:
+            self._shutdown_task = asyncio.create_task(self._shutdown())
+        await self._shutdown_task
+
+    async def _shutdown(self):
+        # ためているログを送ってから切断する
+        try:
+            await log_digest.flush_all()
+        except Exception as e:
+            log.exception("log digest flush failed: %s", e)
+        await image_prober.close()
+        # 終了前にKVの未保存分を書き出して閉じる
+        try:
+            await kv_close()
+        except Exception as e:
+            log.exception("kv close failed: %s", e)
+        await super().close()
+
+_shard_kwargs = {"shard_count": SHARD_COUNT, "shard_ids": SHARD_IDS or None} if SHARD_COUNT else {}
+bot = AnonBoardBot(command_prefix="!", intents=intents, **_client_kwargs, **_shard_kwargs)
+tree = bot.tree
+autodel_scheduler = AutoDeleteScheduler(bot)
+purge_supervisor = PurgeSupervisor(bot, PURGE_MAX_CONCURRENCY)
+log_digest = LogDigest(bot)
+
+# ========= メモリ計測 =========
+# MEMORY_TRACE=フレーム数 で tracemalloc を有効にし、起動直後のスナップショットとの差を /board memory で
+# サブシステム（bot.py の節・ライブラリ）別に出す。計測中は確保のたびに記録するので普段は 0 のまま。
+MEMORY_TRACE_FRAMES = int(os.getenv("MEMORY_TRACE", "0") or 0)
+if MEMORY_TRACE_FRAMES:
+    tracemalloc.start(MEMORY_TRACE_FRAMES)
+_mem_baseline: tracemalloc.Snapshot | None = None
+_SECTION_RE = re.compile(r"^# =+ (.+?) =+$")
+_bot_sections: tuple[list[int], list[str]] | None = None  # (節の開始行, 節名)
+
+def _section_of(lineno: int) -> str:
+    global _bot_sections
+    if _bot_sections is None:
+        starts, names = [], []
+        with open(__file__, encoding="utf-8") as f:
+            for i, line in enumerate(f, 1):
+                m = _SECTION_RE.match(line)
+                if m:
+                    starts.append(i)
+                    names.append(m.group(1))
+        _bot_sections = (starts, names)
+    starts, names = _bot_sections
+    i = bisect.bisect_right(starts, lineno) - 1
+    return names[i] if i >= 0 else "先頭"
+
+def _subsystem(tb: tracemalloc.Traceback) -> str:
+    """確保した場所を、呼び出し元をさかのぼって最初に見つかった bot.py の節にまとめる。なければライブラリ名。"""
+    for frame in reversed(tb):  # 新しいフレームから
+        if frame.filename == __file__:
+            return f"bot: {_section_of(frame.lineno)}"
+    path = tb[-1].filename.replace(os.sep, "/")
+    for lib in ("discord", "aiohttp", "asyncio", "sqlite3", "json"):
+        if f"/{lib}/" in path:
+            return lib
+    return "その他"
+
+def _memory_snapshot() -> tracemalloc.Snapshot:
+    return tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+
+def take_memory_baseline():
+    global _mem_baseline
+    if tracemalloc.is_tracing():
+        _mem_baseline = _memory_snapshot()
+
+def memory_by_subsystem() -> list[tuple[str, int, int]]:
+    """[(サブシステム, 現在のサイズ, 基準からの増減)] を増減の大きい順に。"""
+    snap = _memory_snapshot()
+    if _mem_baseline is not None:
+        stats = [(st.traceback, st.size, st.size_diff) for st in snap.compare_to(_mem_baseline, "traceback")]
+    else:
+        stats = [(st.traceback, st.size, st.size) for st in snap.statistics("traceback")]
+    rows: dict[str, list[int]] = {}
+    for tb, size, diff in stats:
+        row = rows.setdefault(_subsystem(tb), [0, 0])
+        row[0] += size
+        row[1] += diff
+    return sorted(((k, v[0], v[1]) for k, v in rows.items()), key=lambda r: -abs(r[2]))
+
+def process_rss_bytes() -> int | None:
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def cache_counts(client: commands.Bot) -> dict[str, int]:
+    guilds = client.guilds
+    return {
+        "guilds": len(guilds),
+        "channels": sum(len(g.channels) for g in guilds),
+        "members_cached": sum(len(g.members) for g in guilds),
+        "messages_cached": len(client.cached_messages),
+        "channel_configs": len(_chan_cfg),
+        "pending": len(_pending),
+        "panel_msgs": len(_panel_msgs),
+        "autodel_queue": len(autodel_scheduler),
+        "image_cache": len(image_prober),
+    }
+
+# ========= 匿名掲示板 UI =========
+async def _timed(stages: dict[str, float], name: str, aw):
+    """aw を待ち、所要時間（秒）を stages[name] に記録する。"""
+    start = time.perf_counter()
+    try:
+        return await aw
+    finally:
+        stages[name] = time.perf_counter() - start
+
+class PostModal(discord.ui.Modal, title="投稿内容を入力"):
+    """画像付き: 本文は即時公開・画像はログ承認後に追記。画像なし: 即時公開＋ログ記録。"""
+    def __init__(self, channel_id: int, is_anonymous: bool):
+        super().__init__(timeout=180)
+        self.channel_id = channel_id
+        self.is_anonymous = is_anonymous
+        self.content = discord.ui.TextInput(
+            label="本文", style=discord.TextStyle.paragraph,
+            placeholder="ここにメッセージを入力", max_length=2000, required=True
+        )
+        self.add_item(self.content)
+        self.img_url = discord.ui.TextInput(
+            label="画像URL（任意・画像は承認後に反映）", style=discord.TextStyle.short,
+            placeholder="https://...", max_length=500, required=False
+        )
+        self.add_item(self.img_url)
+
+    async def on_submit(self, interaction: discord.Interaction):
+        """公開 → （確認返信・reveal用記録・ログ/承認カード）を並行実行。各段階の所要時間を記録する。"""
+        stages: dict[str, float] = {}
+        t0 = time.perf_counter()
+        await interaction.response.defer(ephemeral=True, thinking=False)
+
+        board_ch = interaction.client.get_channel(self.channel_id)
+        if board_ch is None or not isinstance(board_ch, discord.TextChannel):
+            return await interaction.followup.send("対象チャンネルが見つかりません。", ephemeral=True)
+
+        content = self.content.value.strip()
+        if not content:
+            return await interaction.followup.send("本文が空です。", ephemeral=True)
+
+        # 表示名（匿名は連番）
+        if self.is_anonymous:
+            counter = await _timed(stages, "counter", kv_incr(gkey_counter(self.channel_id)))
+            display_name = f"{counter}"
+        else:
+            display_name = interaction.user.display_name
+
+        # 画像URL抽出（承認フローへ）
+        img = (self.img_url.value or "").strip()
+        if not img:
+            img = extract_first_image_url(content) or ""
+        img = img.strip()
+        has_image = bool(img)
+
+        cfg = channel_config(self.channel_id)
+        log_ch = interaction.client.get_channel(cfg.log_channel_id) if (cfg and cfg.log_channel_id) else None
+
+        # 承認カードを出すときだけ画像を事前確認（公開と並行）
+        probe = None
+        if has_image and IMAGE_PROBE_ENABLED and isinstance(log_ch, discord.TextChannel):
+            probe = asyncio.ensure_future(_timed(stages, "image_probe", image_prober.probe(img)))
+
+        # 本文だけ公開
+        embed = discord.Embed(description=content, color=discord.Color.blurple())
+        embed.set_footer(text=f"投稿者: {display_name}")
+        published, webhook_id = await _timed(stages, "publish", publish_post(interaction.client, board_ch, embed, display_name))
+
+        # 公開マッピング保存（reveal用）
+        post = PostRecord(
+            message_id=published.id,
+            channel_id=self.channel_id,
+            author_id=interaction.user.id,
+            author_name=str(interaction.user),
+            author_display=interaction.user.display_name,
+            anon_display=display_name if self.is_anonymous else None,
+        )
+        jobs = [
+            _timed(stages, "postmap", kv_set_many({
+                gkey_postmap(published.id): post.encode(),
+                gkey_author_index(self.channel_id, interaction.user.id, published.id): str(published.id),
+            })),
+            remember_channel_guild(self.channel_id, interaction.guild_id),
+        ]
+
+        if not has_image:
+            # ログ送信（画像なしでも送る）
+            jobs.append(_timed(stages, "confirm", interaction.followup.send("投稿しました。", ephemeral=True)))
+            if isinstance(log_ch, discord.TextChannel):
+                le = discord.Embed(title="📝 投稿ログ（画像なし）", description=content, color=discord.Color.dark_gray())
+                le.add_field(name="匿名？", value="はい" if self.is_anonymous else "いいえ", inline=True)
+                le.add_field(name="表示名", value=display_name, inline=True)
+                le.add_field(name="投稿先", value=f"<#{self.channel_id}>", inline=True)
+                le.add_field(name="本文メッセージ", value=f"[ジャンプ]({published.jump_url})", inline=False)
+                le.add_field(name="送信者", value=f"{interaction.user.mention} ({interaction.user.id})", inline=False)
+                digest_sec = LogDigest.interval(log_ch.id)
+                if digest_sec:
+                    log_digest.add(log_ch.id, le, digest_sec)
+                else:
+                    jobs.append(_timed(stages, "log", rest(PRIO_LOG, f"send:{log_ch.id}", lambda: log_ch.send(embed=le))))
+        elif not isinstance(log_ch, discord.TextChannel):
+            # 画像あり → 承認カードを出したいがログ先がない
+            jobs.append(_timed(stages, "confirm", interaction.followup.send(
+                "画像は承認制ですが、ログチャンネルが未設定のため画像は反映できませんでした（本文は公開済み）。\n"
+                "管理者に /board setlog で設定してもらってください。",
+                ephemeral=True
+            )))
+        else:
+            # 画像あり → 承認カード（事前確認の結果はカードを出すところで待つ。公開の通知は待たせない）
+            jobs.append(_timed(stages, "confirm", interaction.followup.send(
+                "投稿しました。画像は承認後に反映されます。", ephemeral=True
+            )))
+            jobs.append(_timed(stages, "approval_card", self._send_approval_card(
+                interaction, log_ch, published, content, display_name, img, probe, webhook_id
+            )))
+
+        schedule_panel_repost(interaction.client, board_ch.id)
+        for r in await asyncio.gather(*jobs, return_exceptions=True):
+            if isinstance(r, Exception):
+                log.error(f"[post] step failed in channel {self.channel_id}: {r!r}", exc_info=r)
+        stages["total"] = time.perf_counter() - t0
+        for k, v in stages.items():
+            metrics.observe("post_stage_seconds", v, stage=k)
+        log.debug("[post] channel=%s %s", self.channel_id, " ".join(f"{k}={v * 1000:.1f}ms" for k, v in stages.items()))
+
+    async def _send_approval_card(
+        self,
+        interaction: discord.Interaction,
+        log_ch: discord.TextChannel,
+        published: discord.Message,
+        content: str,
+        display_name: str,
+        img: str,
+        probe: asyncio.Future | None,
+        webhook_id: int | None,
+    ):
+        info = await probe if probe is not None else None
+        if info is not None and not info.ok and info.definitive:
+            # 画像ではない・大きすぎる・4xx・内部アドレス → カードは出さず投稿者にだけ伝える
+            await interaction.followup.send(
+                f"画像を確認できなかったため反映しません：{info.error}（本文は公開済み）。", ephemeral=True
+            )
+            return
+        # 一時的な失敗で確かめきれなかった画像は「未確認」としてカードに出し、管理者の判断に任せる
+        rec = PendingRecord(
+            log_message_id=0,
+            board_channel_id=self.channel_id,
+            board_message_id=published.id,
+            display_name=display_name,
+            content=content,
+            img_url=img,
+            log_channel_id=log_ch.id,
+            author_id=interaction.user.id,
+            anonymous=self.is_anonymous,
+            img_meta=info.summary() if info is not None else "",
+            webhook_id=webhook_id,
+        )
+        pending = approval_card_embed(rec, interaction.guild_id, "pending")
+        view = ApprovalView(self.channel_id)
+        log_msg = await rest(PRIO_LOG, f"send:{log_ch.id}", lambda: log_ch.send(embed=pending, view=view))
+        rec.log_message_id = log_msg.id
+        add_pending(rec)
+        await kv_set(gkey_pending(log_msg.id), rec.encode())
+
+# ---- 永続ビュー：custom_id にチャンネルIDを入れ、再起動後も setup_hook の登録だけで応答する ----
+class PostButton(discord.ui.DynamicItem[discord.ui.Button], template=r"anonboard:btn:post:(?P<channel_id>\d+)"):
+    def __init__(self, channel_id: int):
+        super().__init__(discord.ui.Button(
+            label="匿名で投稿", style=discord.ButtonStyle.primary, emoji="🕵️",
+            custom_id=f"anonboard:btn:post:{channel_id}",
+        ))
+        self.channel_id = channel_id
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match: re.Match[str]):
+        return cls(int(match["channel_id"]))
+
+    async def callback(self, interaction: discord.Interaction):
+        await interaction.response.send_modal(PostModal(self.channel_id, is_anonymous=True))
+
+class ApproveButton(discord.ui.DynamicItem[discord.ui.Button], template=r"anonboard:btn:approve:(?P<channel_id>\d+)"):
+    def __init__(self, board_channel_id: int, disabled: bool = False):
+        super().__init__(discord.ui.Button(
+            label="Approve", style=discord.ButtonStyle.success, emoji="✅", disabled=disabled,
+            custom_id=f"anonboard:btn:approve:{board_channel_id}",
+        ))
+        self.board_channel_id = board_channel_id
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match: re.Match[str]):
+        return cls(int(match["channel_id"]))
+
+    async def callback(self, interaction: discord.Interaction):
+        await _on_approval_click(interaction, approve=True)
+
+class RejectButton(discord.ui.DynamicItem[discord.ui.Button], template=r"anonboard:btn:reject:(?P<channel_id>\d+)"):
+    def __init__(self, board_channel_id: int, disabled: bool = False):
+        super().__init__(discord.ui.Button(
+            label="Reject", style=discord.ButtonStyle.danger, emoji="🛑", disabled=disabled,
+            custom_id=f"anonboard:btn:reject:{board_channel_id}",
+        ))
+        self.board_channel_id = board_channel_id
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match: re.Match[str]):
+        return cls(int(match["channel_id"]))
+
+    async def callback(self, interaction: discord.Interaction):
+        await _on_approval_click(interaction, approve=False)
+
+async def _on_approval_click(interaction: discord.Interaction, approve: bool):
+    if not is_allowed_user(interaction.user):
+        return await interaction.response.send_message("承認権限がありません。", ephemeral=True)
+    # 送信キューが混んでいても3秒の応答期限に間に合うよう、先に応答しておく
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    rec = await claim_pending(interaction.message.id)
+    if rec is None:
+        return await interaction.followup.send("承認待ち情報が見つかりません（処理済みか、ほかの操作で処理中です）。", ephemeral=True)
+    try:
+        err = await resolve_pending(interaction.client, rec, approve=approve)
+    except Exception:
+        await requeue_pending(rec)
+        raise
+    done = "承認して掲示板に画像を反映しました。" if approve else "却下しました（本文は公開済みのまま）。"
+    await interaction.followup.send(err or done, ephemeral=True)
+
+class ApprovalView(discord.ui.View):
+    def __init__(self, board_channel_id: int, disabled: bool = False):
+        super().__init__(timeout=None)
+        self.add_item(ApproveButton(board_channel_id, disabled))
+        self.add_item(RejectButton(board_channel_id, disabled))
+
+class BoardView(discord.ui.View):
+    def __init__(self, channel_id: int):
+        super().__init__(timeout=None)
+        self.channel_id = channel_id
+        self.add_item(PostButton(channel_id))
+
+PERSISTENT_VIEWS_DONE_KEY = "anonboard:meta:persistent_views"  # 旧パネル/承認カードの付け替えが済んだ印
+
+async def upgrade_legacy_views(client: commands.Bot):
+    """永続ビュー導入前に出したパネル・承認カードのボタンを1回だけ付け替える（再掲はしない）。"""
+    await client.wait_until_ready()
+    # シャードごとのプロセスは自分に見えるチャンネルしか直せないので、印もシャードの組ごとに付ける
+    done_key = f"{PERSISTENT_VIEWS_DONE_KEY}:{','.join(map(str, SHARD_IDS))}" if SHARD_IDS else PERSISTENT_VIEWS_DONE_KEY
+    if await kv_get(PERSISTENT_VIEWS_DONE_KEY) or await kv_get(done_key):
+        return
+    edits = []
+    for chid, cfg in list(_chan_cfg.items()):
+        ch = client.get_channel(chid)
+        if cfg.panel_id and isinstance(ch, discord.TextChannel):
+            msg = ch.get_partial_message(cfg.panel_id)
+            edits.append(rest(PRIO_PANEL, f"edit:{chid}", lambda msg=msg, chid=chid: msg.edit(view=BoardView(chid))))
+    for rec in list(_pending.values()):
+        ch = client.get_channel(rec.log_channel_id) if rec.log_channel_id else None
+        if isinstance(ch, discord.TextChannel):
+            msg = ch.get_partial_message(rec.log_message_id)
+            edits.append(rest(PRIO_PANEL, f"edit:{ch.id}",
+                              lambda msg=msg, rec=rec: msg.edit(view=ApprovalView(rec.board_channel_id))))
+    results = await asyncio.gather(*edits, return_exceptions=True)
+    failed = sum(1 for r in results if isinstance(r, Exception))
+    await kv_set(done_key, "1")
+    if edits:
+        log.info(f"[views] upgraded {len(edits) - failed} legacy views ({failed} failed)")
+
+# パネル再掲のデバウンス：投稿が続く間は待ち、静かになってから1回だけ動かす（最長 MAX_DELAY で必ず実行）
+PANEL_REPOST_DELAY = float(os.getenv("PANEL_REPOST_DELAY", "3.0"))
+PANEL_REPOST_MAX_DELAY = float(os.getenv("PANEL_REPOST_MAX_DELAY", "15.0"))
+_panel_msgs: dict[int, discord.Message] = {}      # 直近に出したパネル（削除時に再取得しない）
+_panel_locks: dict[int, asyncio.Lock] = {}
+_panel_due: dict[int, float] = {}                 # channel_id -> 再掲予定（monotonic）
+_panel_repost_tasks: dict[int, asyncio.Task] = {}
+
+async def repost_panel(client: commands.Bot, channel_id: int):
+    """古いパネルを削除 → 新しいパネルを最下部に再掲してID保存"""
+    channel = client.get_channel(channel_id)
+    if channel is None or not isinstance(channel, discord.TextChannel):
+        return
+
+    lock = _panel_locks.setdefault(channel_id, asyncio.Lock())
+    async with lock:
+        cfg = channel_config(channel_id)
+        old = _panel_msgs.pop(channel_id, None)
+        if old is None and cfg and cfg.panel_id:
+            old = channel.get_partial_message(cfg.panel_id)
+        if old is not None:
+            try:
+                await rest(PRIO_PANEL, f"delete:{channel_id}", old.delete)
+            except Exception:
+                pass
+
+        view = BoardView(channel_id)
+        msg = await rest(PRIO_PANEL, f"send:{channel_id}",
+                         lambda: channel.send("**匿名掲示板パネル**\n下のボタンから投稿してください。", view=view))
+        _panel_msgs[channel_id] = msg
+        await set_channel_config(channel_id, "panel_id", msg.id)
+
+def schedule_panel_repost(client: commands.Bot, channel_id: int):
+    """投稿ごとの再掲をまとめる。待機中なら期限を延ばすだけ。"""
+    waiting = channel_id in _panel_due
+    _panel_due[channel_id] = time.monotonic() + PANEL_REPOST_DELAY
+    if not waiting:
+        _panel_repost_tasks[channel_id] = asyncio.create_task(_panel_repost_later(client, channel_id))
+
+async def _panel_repost_later(client: commands.Bot, channel_id: int):
+    deadline = time.monotonic() + PANEL_REPOST_MAX_DELAY
+    try:
+        while True:
+            delay = min(_panel_due[channel_id], deadline) - time.monotonic()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        _panel_due.pop(channel_id, None)
+        await repost_panel(client, channel_id)
+    except asyncio.CancelledError:
+        _panel_due.pop(channel_id, None)
+        raise
+    except Exception as e:
+        log.exception(f"[panel] repost failed in channel {channel_id}: {e}")
+    finally:
+        if _panel_repost_tasks.get(channel_id) is asyncio.current_task():
+            del _panel_repost_tasks[channel_id]
+
+# ---- スラッシュグループ（子コマンドに guild 指定は付けない）----
+board_group = app_commands.Group(name="board", description="匿名掲示板の設定/操作")
+
+@board_group.command(name="setup", description="このチャンネル（または指定先）に掲示板パネルを設置")
+@app_commands.describe(
+    channel="掲示板にするテキストチャンネル（未指定ならこのチャンネル）",
+    reset_counter="匿名連番を0から再開",
+    log_channel="投稿ログ送信先（画像承認用・推奨）"
+)
+async def board_setup(
+    interaction: discord.Interaction,
+    channel: discord.TextChannel | None = None,
+    reset_counter: bool = False,
+    log_channel: discord.TextChannel | None = None
+):
+    if not await guard_allowed(interaction):
+        return
+    target = channel or interaction.channel
+    if not isinstance(target, discord.TextChannel):
+        return await interaction.response.send_message("テキストチャンネルで実行してください。", ephemeral=True)
+    if reset_counter:
+        await kv_set(gkey_counter(target.id), "0")
+    if log_channel:
+        await set_channel_config(target.id, "log_channel_id", log_channel.id)
+    await repost_panel(interaction.client, target.id)
+    txt = f"掲示板パネルを設置しました：{target.mention}\n"
+    if log_channel: txt += f"投稿ログ（承認用）：{log_channel.mention}\n"
+    if reset_counter: txt += "匿名連番をリセットしました。"
+    await interaction.response.send_message(txt, ephemeral=True)
+
+@board_group.command(name="setlog", description="掲示板の投稿ログ先を設定（画像承認用）")
+@app_commands.describe(board_channel="掲示板チャンネル（未指定なら実行場所）", log_channel="ログ送信先")
+async def board_setlog(
+    interaction: discord.Interaction,
+    board_channel: discord.TextChannel | None = None,
+    log_channel: discord.TextChannel | None = None
+):
+    if not await guard_allowed(interaction):
+        return
+    target = board_channel or interaction.channel
+    if not isinstance(target, discord.TextChannel) or not log_channel:
+        return await interaction.response.send_message("対象/ログ先はテキストチャンネルを指定してください。", ephemeral=True)
+    await set_channel_config(target.id, "log_channel_id", log_channel.id)
+    await interaction.response.send_message(f"{target.mention} の投稿ログ先を {log_channel.mention} に設定しました。", ephemeral=True)
+
+@board_group.command(name="logdigest", description="投稿ログ（画像なし）をまとめて送る間隔を設定（0で毎回送信）")
+@app_commands.describe(seconds="まとめる間隔（秒）。0で無効", log_channel="ログ先チャンネル（未指定なら実行場所）")
+async def board_logdigest(
+    interaction: discord.Interaction,
+    seconds: app_commands.Range[int, 0, 3600],
+    log_channel: discord.TextChannel | None = None
+):
+    if not await guard_allowed(interaction):
+        return
+    target = log_channel or interaction.channel
+    if not isinstance(target, discord.TextChannel):
+        return await interaction.response.send_message("テキストチャンネルを指定してください。", ephemeral=True)
+    await set_channel_config(target.id, "log_digest_sec", seconds or None)
+    if not seconds:
+        await interaction.response.send_message(f"{target.mention} の投稿ログは1件ずつ送ります。", ephemeral=True)
+        return await log_digest.flush(target.id)
+    await interaction.response.send_message(
+        f"{target.mention} の投稿ログを {seconds} 秒ごと（または{LOG_DIGEST_MAX_EMBEDS}件たまったら）まとめて送ります。", ephemeral=True
+    )
+
+@board_group.command(name="webhook", description="掲示板の投稿を専用 Webhook から行うか切り替え")
+@app_commands.describe(enabled="有効にするか", channel="掲示板チャンネル（未指定なら実行場所）")
+async def board_webhook_toggle(interaction: discord.Interaction, enabled: bool, channel: discord.TextChannel | None = None):
+    if not await guard_allowed(interaction):
+        return
+    target = channel or interaction.channel
+    if not isinstance(target, discord.TextChannel):
+        return await interaction.response.send_message("テキストチャンネルで実行してください。", ephemeral=True)
+    if not enabled:
+        # Webhook 自体は残す（承認待ちの投稿を後から編集できるように）
+        await set_channel_config(target.id, "webhook_id", None)
+        return await interaction.response.send_message(f"{target.mention} の投稿を通常送信に戻しました。", ephemeral=True)
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    try:
+        await enable_board_webhook(interaction.client, target)
+    except discord.Forbidden:
+        return await interaction.followup.send("Webhook を作成できません（ウェブフックの管理権限が必要です）。", ephemeral=True)
+    await interaction.followup.send(f"{target.mention} の投稿を Webhook から行います（匿名番号がユーザー名になります）。", ephemeral=True)
+
+@board_group.command(name="reset_counter", description="匿名連番を0にリセット")
+@app_commands.describe(channel="対象チャンネル（未指定なら実行場所）")
+async def board_reset_counter(interaction: discord.Interaction, channel: discord.TextChannel | None = None):
+    if not await guard_allowed(interaction):
+        return
+    target = channel or interaction.channel
+    if not isinstance(target, discord.TextChannel):
+        return await interaction.response.send_message("テキストチャンネルで実行してください。", ephemeral=True)
+    await kv_set(gkey_counter(target.id), "0")
+    await interaction.response.send_message(f"匿名連番をリセットしました：{target.mention}", ephemeral=True)
+
+@board_group.command(name="panel", description="パネルを最下部に再掲")
+@app_commands.describe(channel="対象チャンネル（未指定なら実行場所）")
+async def board_panel(interaction: discord.Interaction, channel: discord.TextChannel | None = None):
+    if not await guard_allowed(interaction):
+        return
+    target = channel or interaction.channel
+    if not isinstance(target, discord.TextChannel):
+        return await interaction.response.send_message("テキストチャンネルで実行してください。", ephemeral=True)
+    await repost_panel(interaction.client, target.id)
+    await interaction.response.send_message(f"パネルを再掲しました：{target.mention}", ephemeral=True)
+
+@board_group.command(name="reveal", description="匿名投稿の実投稿者を照会（指定ユーザーのみ）")
+@app_commands.describe(message_link="対象メッセージのリンク（右クリック→リンクをコピー）")
+async def board_reveal(interaction: discord.Interaction, message_link: str):
+    if not await guard_allowed(interaction):
+        return
+    msg = await fetch_message_from_link(interaction.client, message_link)
+    if not msg:
+        return await interaction.response.send_message("メッセージリンクが無効です。正しいリンクを指定してください。", ephemeral=True)
+    data_s = await kv_get(gkey_postmap(msg.id))
+    if not data_s:
+        return await interaction.response.send_message("このメッセージの記録が見つかりません。匿名掲示板の投稿ではない可能性があります。", ephemeral=True)
+    info = PostRecord.decode(msg.id, data_s)
+    desc = (
+        f"**匿名？** {'はい' if info.anonymous else 'いいえ'}\n"
+        f"**匿名表示名**: {info.anon_display or '-'}\n"
+        f"**実投稿者**: <@{info.author_id}> (`{info.author_name}` / 表示名: `{info.author_display}`)\n"
+        f"**メッセージ**: {msg.jump_url}"
+    )
+    await interaction.response.send_message(desc, ephemeral=True)
+
+@board_group.command(name="stats", description="処理時間・件数の統計を表示（指定ユーザーのみ）")
+async def board_stats(interaction: discord.Interaction):
+    if not await guard_allowed(interaction):
+        return
+    lines = metrics.summary_lines()
+    for name, q in outbound.snapshot().items():
+        lines.append(f"rest_queue[{name}] depth={q['depth']} submitted={q['submitted']} failed={q['failed']}")
+    txt = "\n".join(lines) if lines else "まだ計測データがありません。"
+    if len(txt) > 1900:
+        txt = txt[:1900] + "\n…"
+    await interaction.response.send_message(f"```\n{txt}\n```", ephemeral=True)
+
+@board_group.command(name="memory", description="メモリ使用量（RSS・キャッシュ件数・増加の内訳）を表示（指定ユーザーのみ）")
+@app_commands.describe(reset="表示後、増減の基準を今の状態にする")
+async def board_memory(interaction: discord.Interaction, reset: bool = False):
+    if not await guard_allowed(interaction):
+        return
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    rss = process_rss_bytes()
+    if rss is not None:
+        metrics.set_gauge("process_rss_bytes", rss)
+    lines = [f"RSS: {rss / 1024 / 1024:.1f}MB" if rss is not None else "RSS: 取得できません",
+             f"profile: {'lean' if LEAN_PROFILE else 'default'} max_messages={MAX_MESSAGES or 'off'}"]
+    lines += [f"{k:<16} {v:>10,}" for k, v in cache_counts(interaction.client).items()]
+    if tracemalloc.is_tracing():
+        rows = await asyncio.to_thread(memory_by_subsystem)
+        lines.append("")
+        lines.append(f"{'tracemalloc':<28} {'現在':>10} {'起動後の増減':>12}")
+        lines += [f"{name[:28]:<28} {size / 1024:>8.1f}KB {diff / 1024:>+10.1f}KB" for name, size, diff in rows[:15]]
+        if reset:
+            await asyncio.to_thread(take_memory_baseline)
+    else:
+        lines.append("（内訳は MEMORY_TRACE=フレーム数 を設定して起動すると表示されます）")
+    txt = "\n".join(lines)
+    if len(txt) > 1900:
+        txt = txt[:1900] + "\n…"
+    await interaction.followup.send(f"```\n{txt}\n```", ephemeral=True)
+
+@board_group.command(name="export", description="掲示板の投稿記録を gzip JSONL に書き出す（前回の続きから・指定ユーザーのみ）")
+@app_commands.describe(
+    channel="掲示板チャンネル（未指定なら実行場所）",
+    with_content="公開メッセージの本文・画像も取得して含める",
+    restart="続きからではなく最初から書き出し直す（既存ファイルは削除）",
+)
+async def board_export(
+    interaction: discord.Interaction,
+    channel: discord.TextChannel | None = None,
+    with_content: bool = False,
+    restart: bool = False
+):
+    if not await guard_allowed(interaction):
+        return
+    target = channel or interaction.channel
+    if not isinstance(target, discord.TextChannel):
+        return await interaction.response.send_message("テキストチャンネルで実行してください。", ephemeral=True)
+    running = _export_tasks.get(target.id)
+    if running is not None and not running.done():
+        return await interaction.response.send_message(
+            f"{target.mention} は書き出し中です（{_export_progress.get(target.id, 0):,}件済み）。", ephemeral=True
+        )
+    if restart:
+        await reset_export(target.id)
+    await interaction.response.send_message(
+        f"{target.mention} の書き出しを開始しました → `{export_path(target.id)}`（終わったらお知らせします）", ephemeral=True
+    )
+    _export_tasks[target.id] = interaction.client.spawn(_run_export(interaction, target.id, with_content))
+
+async def _run_export(interaction: discord.Interaction, chid: int, with_content: bool):
+    try:
+        n = await export_board(interaction.client, chid, with_content)
+        txt = f"書き出し完了：<#{chid}> {n:,}件を追記 → `{export_path(chid)}`"
+    except Exception as e:
+        log.exception(f"[export] channel={chid} failed: {e}")
+        txt = f"書き出しに失敗しました（{_export_progress.get(chid, 0):,}件までは保存済み・次回は続きから）：{e}"
+    log.info(f"[export] {txt}")
+    try:
+        await interaction.followup.send(txt, ephemeral=True)
+    except discord.HTTPException:
+        pass  # 応答トークンの期限（15分）切れ。結果はログに残っている
+
+HISTORY_PAGE_SIZE = 10
+
+@board_group.command(name="history", description="指定ユーザーの投稿一覧を新しい順に表示（指定ユーザーのみ）")
+@app_commands.describe(user="投稿者", channel="掲示板チャンネル（未指定なら実行場所）", page="ページ（1〜）")
+async def board_history(
+    interaction: discord.Interaction,
+    user: discord.User,
+    channel: discord.TextChannel | None = None,
+    page: app_commands.Range[int, 1, 10000] = 1
+):
+    if not await guard_allowed(interaction):
+        return
+    target = channel or interaction.channel
+    if not isinstance(target, discord.TextChannel):
+        return await interaction.response.send_message("テキストチャンネルで実行してください。", ephemeral=True)
+    ids, has_more = await author_posts_page(target.id, user.id, (page - 1) * HISTORY_PAGE_SIZE, HISTORY_PAGE_SIZE)
+    if not ids:
+        return await interaction.response.send_message(f"{user.mention} の投稿記録はありません（{page}ページ目）。", ephemeral=True)
+    lines = [f"**{user}** の投稿（{target.mention} / {page}ページ目）"]
+    for mid in ids:
+        ts = int(discord.utils.snowflake_time(mid).timestamp())
+        lines.append(f"<t:{ts}:f> https://discord.com/channels/{target.guild.id}/{target.id}/{mid}")
+    if has_more:
+        lines.append(f"続き: `page={page + 1}`")
+    await interaction.response.send_message("\n".join(lines), ephemeral=True)
+
+@board_group.command(name="approve_all", description="この掲示板の承認待ち画像をすべて承認")
+@app_commands.describe(channel="掲示板チャンネル（未指定なら実行場所）")
+async def board_approve_all(interaction: discord.Interaction, channel: discord.TextChannel | None = None):
+    await _resolve_all_command(interaction, channel, approve=True)
+
+@board_group.command(name="reject_all", description="この掲示板の承認待ち画像をすべて却下")
+@app_commands.describe(channel="掲示板チャンネル（未指定なら実行場所）")
+async def board_reject_all(interaction: discord.Interaction, channel: discord.TextChannel | None = None):
+    await _resolve_all_command(interaction, channel, approve=False)
+
+async def _resolve_all_command(interaction: discord.Interaction, channel: discord.TextChannel | None, approve: bool):
+    if not await guard_allowed(interaction):
+        return
+    target = channel or interaction.channel
+    if not isinstance(target, discord.TextChannel):
+        return await interaction.response.send_message("テキストチャンネルで実行してください。", ephemeral=True)
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    ok, failed = await resolve_all_pending(interaction.client, target.id, approve)
+    verb = "承認" if approve else "却下"
+    txt = f"{target.mention} の承認待ちを {ok}件 {verb}しました。"
+    if failed:
+        txt += f"（{failed}件は失敗・承認待ちのまま）"
+    await interaction.followup.send(txt, ephemeral=True)
+
+@board_group.command(name="retention", description="投稿記録（reveal用）の保持日数を設定（0で既定値）")
+@app_commands.describe(days="保持日数（0〜3650、0なら既定値）", channel="対象チャンネル（未指定なら実行場所）")
+async def board_retention(
+    interaction: discord.Interaction,
+    days: app_commands.Range[int, 0, 3650],
+    channel: discord.TextChannel | None = None
+):
+    if not await guard_allowed(interaction):
+        return
+    target = channel or interaction.channel
+    if not isinstance(target, discord.TextChannel):
+        return await interaction.response.send_message("テキストチャンネルで実行してください。", ephemeral=True)
+    await set_channel_config(target.id, "retention_days", int(days) or None)
+    effective = retention_days_for(target.id)
+    txt = f"{effective}日" if effective else "無期限"
+    await interaction.response.send_message(f"{target.mention} の投稿記録の保持期間：**{txt}**", ephemeral=True)
+
+@board_group.command(name="storage", description="保存データの件数・サイズをキー種別ごとに表示（指定ユーザーのみ）")
+async def board_storage(interaction: discord.Interaction):
+    if not await guard_allowed(interaction):
+        return
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    stats = await store_stats_by_prefix()
+    lines = [f"{p:<28} {c:>8}件 {b / 1024:>10.1f}KB" for p, (c, b) in sorted(stats.items(), key=lambda x: -x[1][1])]
+    total_c = sum(c for c, _ in stats.values())
+    total_b = sum(b for _, b in stats.values())
+    lines.append(f"{'合計':<28} {total_c:>8}件 {total_b / 1024:>10.1f}KB")
+    txt = "\n".join(lines)
+    if len(txt) > 1900:
+        txt = txt[:1900] + "\n…"
+    await interaction.followup.send(f"```\n{txt}\n```", ephemeral=True)
+
+# ---- 送信後◯秒で削除（新規のみ） ----
+@board_group.command(name="autodel_start", description="このチャンネルで新規メッセージを自動削除します")
+@app_commands.describe(seconds="削除までの秒数（10〜604800）")
+async def board_autodel_start(interaction: discord.Interaction, seconds: app_commands.Range[int, 10, 604800]):
+    if not await guard_allowed(interaction):
+        return
+    await set_channel_config(interaction.channel_id, "autodel_sec", int(seconds))
+    await interaction.response.send_message(
+        f"このチャンネルの新規メッセージを **{int(seconds)}秒後** に自動削除します。\n"
+        "※ ピン留めと掲示板パネルは削除対象外です。",
+        ephemeral=True
+    )
+
+@board_group.command(name="autodel_stop", description="このチャンネルの自動削除を停止します")
+async def board_autodel_stop(interaction: discord.Interaction):
+    if not await guard_allowed(interaction):
+        return
+    await set_channel_config(interaction.channel_id, "autodel_sec", None)
+    await interaction.response.send_message("このチャンネルの自動削除を **停止** しました。", ephemeral=True)
+
+# ---- トップレベル：掲示板とは無関係の定期掃除コマンド（ギルド即時反映）----
+def guild_only_deco(func):
+    # 複数ギルド対応（環境変数 GUILD_IDS に列挙）
+    return app_commands.guilds(*[discord.Object(id=g) for g in (GUILD_IDS or [PRIMARY_GUILD_ID])])(func)
+
+@tree.command(name="purge_start", description="一定間隔で古い履歴を定期削除（掲示板とは無関係）")
+@guild_only_deco
+@app_commands.describe(
+    interval_seconds="実行間隔（60〜86400秒）",
+    keep_hours="保存期間（1〜720時間：これより古いメッセージを削除）",
+    batch_limit="1回の最大削除数（10〜1000、既定200）"
+)
+async def purge_start(
+    interaction: discord.Interaction,
+    interval_seconds: app_commands.Range[int, 60, 86400],
+    keep_hours: app_commands.Range[int, 1, 720],
+    batch_limit: app_commands.Range[int, 10, 1000] = 200
+):
+    # Botの権限チェック
+    me = interaction.guild.me if interaction.guild else None
+    if not (me and interaction.channel.permissions_for(me).manage_messages):
+        return await interaction.response.send_message("ボットに **メッセージの管理** 権限が必要です。", ephemeral=True)
+
+    cfg = {"interval": int(interval_seconds), "keep_hours": int(keep_hours), "batch_limit": int(batch_limit)}
+    await kv_set(gkey_purge(interaction.channel_id), json.dumps(cfg, ensure_ascii=False))
+    await start_purge_for_channel(interaction.client, interaction.channel_id, cfg["interval"], cfg["keep_hours"], cfg["batch_limit"])
+    await interaction.response.send_message(
+        f"✅ 定期掃除を開始しました（掲示板とは無関係）。\n"
+        f"- 実行間隔: **{cfg['interval']}秒**\n"
+        f"- 保存期間: **{cfg['keep_hours']}時間**\n"
+        f"- 1回の上限: **{cfg['batch_limit']}件**",
+        ephemeral=True
+    )
+
+@tree.command(name="purge_stop", description="定期掃除を停止（掲示板とは無関係）")
+@guild_only_deco
+async def purge_stop(interaction: discord.Interaction):
+    await kv_del_many([gkey_purge(interaction.channel_id), gkey_purge_cursor(interaction.channel_id)])
+    await stop_purge_for_channel(interaction.channel_id)
+    await interaction.response.send_message("⏹️ 定期掃除を停止しました。", ephemeral=True)
+
+@tree.command(name="purge_status", description="定期掃除ジョブの状態を表示（掲示板とは無関係）")
+@guild_only_deco
+async def purge_status(interaction: discord.Interaction):
+    lines = []
+    for job in sorted(purge_supervisor.jobs.values(), key=lambda j: j.next_run):
+        ch = interaction.client.get_channel(job.channel_id)
+        if ch is None or getattr(ch, "guild", None) is None or ch.guild.id != interaction.guild_id:
+            continue
+        last = f"<t:{int(job.last_run)}:R>" if job.last_run else "-"
+        state = "実行中" if job.running else f"<t:{int(job.next_run)}:R>"
+        lines.append(
+            f"<#{job.channel_id}> 間隔 {job.interval}秒 / 保存 {job.keep_hours}時間\n"
+            f"　前回: {last}（{job.last_deleted}件） / 次回: {state} / 累計: {job.deleted_total}件"
+        )
+    txt = "\n".join(lines) if lines else "このサーバーで動いている定期掃除はありません。"
+    await interaction.response.send_message(txt[:2000], ephemeral=True)
+
+# ---- /ping ----
+@tree.command(name="ping", description="生存確認")
+@guild_only_deco
+async def ping(interaction: discord.Interaction):
+    await interaction.response.send_message("Pong! 🏓", ephemeral=True)
+
+# ---- on_message: 送信後◯秒削除のスケジュール ----
+@bot.event
+async def on_message(message: discord.Message):
+    start = time.perf_counter()
+    try:
+        await _handle_message(message)
+    finally:
+        metrics.observe("on_message_seconds", time.perf_counter() - start)
+
+async def _handle_message(message: discord.Message):
+    await bot.process_commands(message)
+    if not isinstance(message.channel, discord.TextChannel):
+        return
+    if message.author is None:
+        return
+
+    if not _chan_cfg_loaded:
+        await load_channel_configs()
+    # 未設定チャンネルは辞書を1回引くだけで終わる
+    cfg = _chan_cfg.get(message.channel.id)
+    if cfg is None or not cfg.autodel_sec:
+        return
+    seconds = cfg.autodel_sec
+
+    # ピン留めとパネルは削除対象外（掲示板運用上の仕様）
+    if getattr(message, "pinned", False):
+        return
+    if cfg.panel_id == message.id:
+        return
+
+    await autodel_scheduler.schedule(message.channel.id, message.id, seconds, message.guild.id if message.guild else None)
+
+# ---- 起動処理（setup_hook から1回だけ。再接続で on_ready が何度来ても繰り返さない） ----
+CMDSYNC_KEY = "anonboard:meta:cmdsync:{guild_id}"  # 最後に同期したコマンド定義のハッシュ
+FORCE_COMMAND_SYNC = os.getenv("FORCE_COMMAND_SYNC", "") == "1"
+
+def _command_tree_hash(guild: discord.abc.Snowflake) -> str:
+    payload = [c.to_dict(tree) for c in tree.get_commands(guild=guild)]
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+async def _sync_guild(gid: int):
+    guild = discord.Object(id=gid)
+    key = CMDSYNC_KEY.format(guild_id=gid)
+    digest = _command_tree_hash(guild)
+    if not FORCE_COMMAND_SYNC and await kv_get(key) == digest:
+        log.info(f"Commands unchanged for guild {gid}; sync skipped")
+        return
+    await tree.sync(guild=guild)
+    await kv_set(key, digest)
+    log.info(f"Synced commands to guild {gid}")
+
+async def sync_commands():
+    # ギルド同期（即時反映）を並行で。定義が前回と同じギルドは飛ばす
+    results = await asyncio.gather(*(_sync_guild(gid) for gid in GUILD_IDS), return_exceptions=True)
+    for gid, r in zip(GUILD_IDS, results):
+        if isinstance(r, Exception):
+            log.error(f"Command sync failed for guild {gid}: {r!r}", exc_info=r)
+
+async def restore_purge_jobs(client: commands.Bot):
+    """定期掃除ジョブを復元（掲示板とは無関係）。チャンネルキャッシュが揃ってからバックグラウンドで。"""
+    await client.wait_until_ready()
+    restored = 0
+    async for k, v in kv_scan(PURGE_PREFIX):
+        try:
+            ch_id = int(k.split(":")[-1])
+            cfg = json.loads(v)
+            interval = int(cfg.get("interval", 600))
+            keep_hours = int(cfg.get("keep_hours", 24))
+            batch_limit = int(cfg.get("batch_limit", 200))
+        except Exception:
+            continue
+        await start_purge_for_channel(client, ch_id, interval, keep_hours, batch_limit)
+        restored += 1
+    if restored:
+        log.info(f"[purge] restored {restored} jobs")
+
+async def startup(client: "AnonBoardBot"):
+    # /board グループの登録（子コマンドに guild 指定は不可なので、ツリー側でまとめて同期）
+    if board_group not in tree.get_commands():
+        tree.add_command(board_group)
+
+    # 操作に必要なメモリ上の状態だけ先に用意する（KVを読むだけなのですぐ終わる）
+    await load_channel_configs()
+    await load_pending_queue()
+    await autodel_scheduler.restore()
+    autodel_scheduler.start()
+    try:
+        await start_metrics_exporters()
+    except Exception as e:
+        log.exception("start metrics exporters failed: %s", e)
+
+    take_memory_baseline()
+
+    # 残りは接続を待たせないようバックグラウンドで
+    client.spawn(restore_purge_jobs(client))   # 受け持ちギルドのチャンネルだけ
+    client.spawn(upgrade_legacy_views(client))
+    if SHARD_IDS:
+        client.spawn(_chancfg_refresh_loop())  # 他プロセスが書いた設定（ログまとめ・guild_id など）を取り込む
+    if is_primary_shard(client):
+        # 共有ストア全体に対する処理は1プロセスだけ
+        client.spawn(sync_commands())
+        client.spawn(_compact_loop())          # 保持期間切れ・孤児記録の定期削除
+        client.spawn(backfill_author_index())
+
+# ---- ready ----
+@bot.event
+async def on_ready():
+    user_info = "(user: None)" if bot.user is None else f"{bot.user} (ID: {bot.user.id})"
+    log.info(f"Logged in as {user_info}")
+
+# ---- main ----
+def main():
+    if not DISCORD_TOKEN:
+        log.error("DISCORD_TOKEN が未設定です（Railway Variables で設定してください）")
+        sys.exit(1)
+    if SHARD_IDS and not SHARD_COUNT:
+        log.error("SHARD_IDS を使うときは SHARD_COUNT も設定してください")
+        sys.exit(1)
+    if any(i >= SHARD_COUNT for i in SHARD_IDS):
+        log.error(f"SHARD_IDS は 0〜{SHARD_COUNT - 1} の範囲で指定してください")
+        sys.exit(1)
+    if SHARD_IDS and KV_BACKEND != "sqlite":
+        log.error("複数プロセスでシャードを分けるときは KV_BACKEND=sqlite（共有ファイル）が必要です")
+        sys.exit(1)
+    bot.run(DISCORD_TOKEN)
+
+if __name__ == "__main__":
+    main()
+